@@ -0,0 +1,82 @@
+import asyncio
+import json
+import random
+from dataclasses import dataclass
+from typing import Callable, Dict
+
+import pytest
+
+from cacheme.models import Node
+from cacheme.serializer import (
+    CompressedMsgPackSerializer,
+    DictionaryCompressedSerializer,
+    MsgPackSerializer,
+    Serializer,
+)
+from cacheme.storages.redis import RedisStorage
+
+KEYS = 2000
+TRAIN_SAMPLES = 100
+
+
+@dataclass
+class DocNode(Node):
+    uid: int
+    serializer_name: str
+
+    def key(self) -> str:
+        return f"dict-bench:{self.serializer_name}:{self.uid}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+
+
+# documents of same shape with varied fields, like cached rows of one node class
+@pytest.fixture(params=["small", "medium"])
+def payload(request):
+    with open(f"benchmarks/{request.param}.json") as f:
+        content_json = json.loads(f.read())
+    rand = random.Random(0)
+    docs = []
+    for uid in range(KEYS):
+        doc = json.loads(json.dumps(content_json))
+        for item in doc if isinstance(doc, list) else [doc]:
+            item["index"] = uid
+            item["age"] = rand.randint(18, 90)
+            item["balance"] = f"${rand.random() * 10000:.2f}"
+            item["guid"] = f"{rand.getrandbits(128):032x}"
+        docs.append(doc)
+    return docs
+
+
+async def redis_memory(serializer, name, docs):
+    storage = RedisStorage("redis://localhost:6379")
+    await storage.connect()
+    nodes = [DocNode(uid, name) for uid in range(KEYS)]
+    for node, doc in zip(nodes, docs):
+        await storage.set(node, doc, None, serializer)
+    total = 0
+    for node in nodes:
+        total += await storage.client.memory_usage(node.full_key())
+    await storage.client.delete(*[node.full_key() for node in nodes])
+    await storage.close()
+    return total
+
+
+@pytest.mark.parametrize("serializer", ["msgpack", "compressed", "dictionary"])
+def test_redis_memory(benchmark, serializer, payload):
+    serializers: Dict[str, Callable[[], Serializer]] = {
+        "msgpack": lambda: MsgPackSerializer(),
+        "compressed": lambda: CompressedMsgPackSerializer(),
+        "dictionary": lambda: DictionaryCompressedSerializer(
+            MsgPackSerializer(), train_samples=TRAIN_SAMPLES
+        ),
+    }
+    s = serializers[serializer]()
+    loop = asyncio.events.new_event_loop()
+    memory = loop.run_until_complete(redis_memory(s, serializer, payload))
+    loop.close()
+    # memory of KEYS values in redis, including first TRAIN_SAMPLES values
+    # compressed before dictionary is trained
+    benchmark.extra_info["redis_bytes_per_key"] = memory / KEYS
+    benchmark(lambda: [s.loads(s.dumps(doc)) for doc in payload[:100]])
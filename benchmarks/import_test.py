@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+from typing import Dict, List
+
+import pytest
+
+# cumulative import time of cacheme in microseconds, fails the benchmark if exceeded
+IMPORT_TIME_LIMIT = int(os.environ.get("CACHEME_IMPORT_TIME_LIMIT", "150000"))
+
+# imported on first use only
+LAZY_MODULES = ["theine", "pydantic", "msgpack"]
+
+
+def import_times(statement: str) -> Dict[str, int]:
+    """
+    Run statement in a fresh interpreter with -X importtime, return cumulative
+    import time of each module in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_time(benchmark):
+    samples: List[Dict[str, int]] = []
+
+    def run():
+        samples.append(import_times("import cacheme"))
+
+    benchmark.pedantic(run, rounds=5)
+    for module in LAZY_MODULES:
+        assert module not in samples[0]
+    best = min(times["cacheme"] for times in samples)
+    benchmark.extra_info["cacheme_import_us"] = best
+    assert best < IMPORT_TIME_LIMIT
+
+
+@pytest.mark.parametrize(
+    "statement,module",
+    [
+        ("from cacheme import BloomFilter", "theine"),
+        ("from cacheme import Storage; Storage('local://lru', size=10)", "theine"),
+        (
+            "from cacheme.serializer import MsgPackSerializer as S; S().dumps(1)",
+            "msgpack",
+        ),
+        (
+            "from cacheme.serializer import JSONSerializer as S; "
+            'S().loads(b\'{"__class__": "datetime.date", "data": "2023-01-01"}\')',
+            "pydantic",
+        ),
+    ],
+)
+def test_lazy_import(benchmark, statement, module):
+    times = benchmark.pedantic(import_times, args=(statement,), rounds=1)
+    assert module in times
@@ -0,0 +1,55 @@
+import asyncio
+from dataclasses import dataclass
+
+import pytest
+
+from cacheme import Cache, Node, Storage, get, register_storage
+from cacheme.instrumentation import add_hook, remove_hook
+
+REQUESTS = 10000
+
+
+@dataclass
+class HookNode(Node):
+    uid: int
+
+    def key(self) -> str:
+        return f"uid:{self.uid}"
+
+    async def load(self) -> int:
+        return self.uid
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="hook-bench", ttl=None)]
+
+
+async def bench_run(nodes):
+    for node in nodes:
+        await get(node)
+
+
+def noop(event):
+    return
+
+
+# local hit get with hooks disabled/enabled, disabled should match baseline
+@pytest.mark.parametrize("hooks", ["disabled", "noop"])
+def test_hook_overhead(benchmark, hooks):
+    loop = asyncio.events.new_event_loop()
+    asyncio.events.set_event_loop(loop)
+    loop.run_until_complete(
+        register_storage("hook-bench", Storage(url="local://tlfu", size=REQUESTS))
+    )
+    nodes = [HookNode(uid=i) for i in range(REQUESTS)]
+    loop.run_until_complete(bench_run(nodes))
+    if hooks == "noop":
+        add_hook(noop)
+    benchmark.pedantic(
+        lambda: loop.run_until_complete(bench_run(nodes)),
+        rounds=20,
+    )
+    if hooks == "noop":
+        remove_hook(noop)
+    asyncio.events.set_event_loop(None)
+    loop.close()
@@ -0,0 +1,88 @@
+import asyncio
+import json
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from cacheme.models import Node
+from cacheme.serializer import MsgPackSerializer
+from cacheme.storages.base import BaseStorage
+from cacheme.storages.offload import OffloadPolicy
+
+
+class MemoryStorage(BaseStorage):
+    # serialize cost only, no network
+    def __init__(self, address: str):
+        super().__init__(address=address)
+        self.data: Dict[str, Any] = {}
+
+    async def get_by_key(self, key: str) -> Any:
+        return self.data.get(key)
+
+    async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
+        return {k: self.data.get(k) for k in keys}
+
+    async def set_by_key(self, key: str, value: Any, ttl):
+        self.data[key] = {"value": value, "expire": None}
+
+    async def set_by_keys(self, data: Dict[str, Any], ttl):
+        for k, v in data.items():
+            await self.set_by_key(k, v, ttl)
+
+
+@dataclass
+class PayloadNode(Node):
+    uid: int
+
+    def key(self) -> str:
+        return f"offload:{self.uid}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+
+
+async def lag_monitor(lags: List[float], stop: asyncio.Event):
+    interval = 0.001
+    while not stop.is_set():
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - start - interval)
+
+
+# mixed payload sizes: a few ~2MB documents among small ones
+async def run(policy: Optional[OffloadPolicy]) -> float:
+    with open("benchmarks/large.json") as f:
+        large = json.load(f)
+    with open("benchmarks/small.json") as f:
+        small = json.load(f)
+    storage = MemoryStorage("memory://")
+    storage.offload = policy
+    serializer = MsgPackSerializer()
+    nodes = [PayloadNode(uid=i) for i in range(200)]
+    data = [(n, [large] * 40 if n.uid % 50 == 0 else small) for n in nodes]
+    await storage.set_all(data, None, serializer)
+    lags: List[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(lag_monitor(lags, stop))
+    await asyncio.sleep(0.01)
+    for _ in range(5):
+        await storage.get_all(nodes, serializer)
+        await storage.get(nodes[0], serializer)
+    stop.set()
+    await monitor
+    return max(lags)
+
+
+@pytest.mark.parametrize("mode", ["inline", "thread"])
+def test_event_loop_lag(benchmark, mode):
+    policy = OffloadPolicy(threshold=256 * 1024) if mode == "thread" else None
+    lags: List[float] = []
+
+    def bench():
+        lags.append(asyncio.run(run(policy)))
+
+    benchmark.pedantic(bench, rounds=5)
+    # max event loop lag in milliseconds while decoding
+    benchmark.extra_info["max_lag_ms"] = min(lags) * 1000
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from cacheme.serializer import MsgPackSerializer
+from cacheme.storages.redis import RedisStorage
+
+KEYS = 1000
+
+
+@pytest.fixture(params=["small", "medium", "large"])
+def payload(request):
+    with open(f"benchmarks/{request.param}.json") as f:
+        content_json = json.loads(f.read())
+    return [{"uid": uid, "data": content_json} for uid in range(KEYS)]
+
+
+@pytest.fixture(params=["legacy", "binary"])
+def storage(request):
+    return RedisStorage(
+        "redis://localhost:6379", legacy_envelope=request.param == "legacy"
+    )
+
+
+# dumps and envelope of KEYS values, without network
+def test_envelope_set(benchmark, storage, payload):
+    serializer = MsgPackSerializer()
+
+    def run():
+        return [
+            storage.pack(storage.deserialize(v, serializer), 60000, 0) for v in payload
+        ]
+
+    blobs = benchmark(run)
+    benchmark.extra_info["bytes_per_key"] = sum(len(b) for b in blobs) / KEYS
+
+
+# envelope parse and loads of KEYS values, without network
+def test_envelope_get(benchmark, storage, payload):
+    serializer = MsgPackSerializer()
+    blobs = [
+        storage.pack(storage.deserialize(v, serializer), 60000, 0) for v in payload
+    ]
+    benchmark(lambda: [storage.serialize(b, serializer) for b in blobs])
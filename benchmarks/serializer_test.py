@@ -0,0 +1,70 @@
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict
+
+import pytest
+
+from cacheme.serializer import (
+    AdaptiveCompressedSerializer,
+    BinaryPickleSerializer,
+    CompressedJSONSerializer,
+    CompressedMsgPackSerializer,
+    CompressedPickleSerializer,
+    JSONSerializer,
+    MsgPackSerializer,
+    PickleSerializer,
+    Serializer,
+)
+
+SERIALIZERS: Dict[str, Serializer] = {
+    "pickle": PickleSerializer(),
+    "binary_pickle": BinaryPickleSerializer(),
+    "json": JSONSerializer(),
+    "msgpack": MsgPackSerializer(),
+    "compressed_pickle": CompressedPickleSerializer(),
+    "compressed_json": CompressedJSONSerializer(),
+    "compressed_msgpack": CompressedMsgPackSerializer(),
+    "adaptive_msgpack": AdaptiveCompressedSerializer(MsgPackSerializer()),
+}
+
+
+@dataclass
+class Bar:
+    a: int
+    b: str
+
+
+def load_json(name: str):
+    with open(f"benchmarks/{name}.json") as f:
+        return json.load(f)
+
+
+# payloads like tests/test_serializers.py, plus json documents and a large blob
+PAYLOADS = {
+    "mixed": lambda: {
+        "a": "a",
+        "b": 2,
+        "ll": [1, 2, "3", {"a": "b"}],
+        "bar": [Bar(a=i, b=str(i)) for i in range(10)],
+        "dt": datetime(2023, 1, 1),
+        "td": timedelta(seconds=20),
+    },
+    "small": lambda: load_json("small"),
+    "medium": lambda: load_json("medium"),
+    "large": lambda: load_json("large"),
+    "blob": lambda: b"x" * 2_000_000,
+}
+
+
+@pytest.mark.parametrize("payload", list(PAYLOADS.keys()))
+@pytest.mark.parametrize("serializer", list(SERIALIZERS.keys()))
+def test_serializer_roundtrip(benchmark, serializer, payload):
+    if serializer in ("json", "compressed_json") and payload in ("mixed", "blob"):
+        pytest.skip("not supported by json")
+    s = SERIALIZERS[serializer]
+    value = PAYLOADS[payload]()
+    blob = s.dumps(value)
+    # payload size is reported with timing
+    benchmark.extra_info["size"] = len(blob)
+    benchmark(lambda: s.loads(s.dumps(value)))
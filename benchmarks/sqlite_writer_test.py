@@ -0,0 +1,73 @@
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from cacheme import Node
+from cacheme.serializer import MsgPackSerializer
+from cacheme.storages.sqlite import SQLiteStorage
+from tests.utils import setup_storage
+
+WRITERS = 50
+WRITES = 200
+
+
+@dataclass
+class WriteNode(Node):
+    uid: str
+
+    def key(self) -> str:
+        return f"uid:{self.uid}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+
+
+async def bench_run(storage: SQLiteStorage, lags: list):
+    serializer = MsgPackSerializer()
+    done = False
+
+    # sleep 1ms in a loop, lag is how late each wake up is
+    async def monitor():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    async def writer(w: int):
+        for i in range(WRITES):
+            node = WriteNode(uid=f"{w}-{i}")
+            await storage.set(
+                node, {"uid": node.uid}, timedelta(seconds=60), serializer
+            )
+
+    task = asyncio.create_task(monitor())
+    await asyncio.gather(*[writer(w) for w in range(WRITERS)])
+    done = True
+    await task
+
+
+# WRITERS * WRITES concurrent sets, event loop lag recorded in extra_info
+def test_sqlite_write_loop_lag(benchmark):
+    filename = f"bench{random.randint(0, 50000)}"
+    loop = asyncio.events.new_event_loop()
+    asyncio.events.set_event_loop(loop)
+    storage = SQLiteStorage(f"sqlite:///{filename}", table="data")
+    loop.run_until_complete(storage.connect())
+    loop.run_until_complete(setup_storage(storage))
+    lags: list = []
+    benchmark.pedantic(
+        lambda: loop.run_until_complete(bench_run(storage, lags)), rounds=5
+    )
+    lags.sort()
+    benchmark.extra_info["lag_p50_ms"] = lags[len(lags) // 2] * 1000
+    benchmark.extra_info["lag_p99_ms"] = lags[int(len(lags) * 0.99)] * 1000
+    benchmark.extra_info["lag_max_ms"] = lags[-1] * 1000
+    loop.run_until_complete(storage.close())
+    asyncio.events.set_event_loop(None)
+    loop.close()
+    for suffix in ["", "-shm", "-wal"]:
+        if os.path.exists(f"{filename}{suffix}"):
+            os.remove(f"{filename}{suffix}")
@@ -1,7 +1,20 @@
-from theine import BloomFilter
+from typing import TYPE_CHECKING, Any
 
 from cacheme.core import (Memoize, build_node, get, get_all, invalidate, nodes,
                           refresh, stats)
 from cacheme.data import register_storage
 from cacheme.models import Cache, DynamicNode, Node, set_prefix
 from cacheme.storages import Storage
+
+if TYPE_CHECKING:
+    from theine import BloomFilter
+
+
+# theine is imported on first use, it's slow to import and only needed by local
+# storage and BloomFilter doorkeeper
+def __getattr__(name: str) -> Any:
+    if name == "BloomFilter":
+        from theine import BloomFilter
+
+        return BloomFilter
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,4 +1,4 @@
-from asyncio import Event, Future
+from asyncio import FIRST_COMPLETED, CancelledError, Event, Future, ensure_future, wait
 from collections import OrderedDict
 from functools import update_wrapper
 from time import time_ns
@@ -20,7 +20,9 @@ from typing import (
 
 from typing_extensions import ParamSpec, Protocol
 
-from cacheme.interfaces import DoorKeeper, Metrics, Serializer, Node
+from cacheme import instrumentation
+from cacheme.instrumentation import _hooks
+from cacheme.interfaces import CacheMetrics, DoorKeeper, Metrics, Serializer, Node
 from cacheme.models import (
     Cache,
     DynamicNode,
@@ -29,6 +31,7 @@ from cacheme.models import (
     get_nodes,
     sentinel,
 )
+from cacheme.storages.breaker import CircuitOpenError
 
 
 P = ParamSpec("P")
@@ -47,6 +50,9 @@ class Locker:
 
 _awaits: Dict[str, Future] = {}
 
+# returned by a remote tier read failed with circuit breaker enabled
+_failed = object()
+
 
 def _awaits_len():
     return len(_awaits)
@@ -70,6 +76,7 @@ async def get(node: Node, load_fn=None):
     :param load_fn: override load function, which will be called instead of node load function if set.
     """
     metrics = node.Meta.metrics
+    metrics._tick()
     result = sentinel
     caches = node.Meta.caches
     local_caches: List[Cache] = []
@@ -84,13 +91,21 @@ async def get(node: Node, load_fn=None):
 
     # try get cached data from local storages first
     for cache in local_caches:
+        if _hooks:
+            start = time_ns()
         result = cache.storage.get_sync(node, None)
+        if _hooks:
+            instrumentation.emit(
+                instrumentation.LOCAL, node.__class__, 1, cache.storage_name, start
+            )
         if result is not sentinel:
             metrics._hit_count += 1
+            metrics.cache(cache.storage_name)._hit_count += 1
             # return fast if hit on first local cache
             if not miss:
                 return result
             break
+        metrics.cache(cache.storage_name)._miss_count += 1
         miss.append(cache)
 
     # can't find cached result in any local storage, try load from remote storage
@@ -104,7 +119,13 @@ async def get(node: Node, load_fn=None):
             _awaits[node.full_key()] = future
             now = time_ns()
             try:
-                result = await _load_from_caches(node, remote_caches, miss, load_fn)
+                result = await _load_from_caches(
+                    node,
+                    [c for c in remote_caches if not _skip_tier(node, c, metrics)],
+                    miss,
+                    metrics,
+                    load_fn,
+                )
             except Exception as e:
                 metrics._load_failure_count += 1
                 metrics._total_load_time += time_ns() - now
@@ -115,11 +136,41 @@ async def get(node: Node, load_fn=None):
             future.set_result(result)
         else:
             metrics._hit_count += 1
+            metrics._wait_count += 1
+            # hooks may be added while waiting, check snapshot of stage start
+            hooked = bool(_hooks)
+            start = time_ns() if hooked else 0
             result = await future
+            if hooked:
+                instrumentation.emit(
+                    instrumentation.WAIT, node.__class__, 1, None, start
+                )
 
     # fill missing caches
     for cache in miss:
-        await cache.storage.set(node, result, cache.ttl, node.Meta.serializer)
+        cache_metrics = metrics.cache(cache.storage_name)
+        if not cache.storage.allow():
+            cache_metrics._bypass_count += 1
+            continue
+        hooked = bool(_hooks)
+        start = time_ns() if hooked else 0
+        try:
+            await cache.storage.set(node, result, cache.ttl, node.Meta.serializer)
+        except CircuitOpenError:
+            cache_metrics._bypass_count += 1
+            continue
+        except Exception as e:
+            cache_metrics._fill_failure_count += 1
+            # failure is recorded by breaker, don't fail request
+            if cache.storage.breaker is not None:
+                continue
+            _awaits.pop(node.full_key(), None)
+            raise (e)
+        cache_metrics._fill_count += 1
+        if hooked:
+            instrumentation.emit(
+                instrumentation.FILL, node.__class__, 1, cache.storage_name, start
+            )
     # remove from tmp cache after fill
     _awaits.pop(node.full_key(), None)
 
@@ -128,22 +179,159 @@ async def get(node: Node, load_fn=None):
 
 # try load data from remote storages, load from source if not found
 async def _load_from_caches(
-    node: Node, caches: List[Cache], miss: List[Cache], load_fn=None
+    node: Node, caches: List[Cache], miss: List[Cache], metrics: Metrics, load_fn=None
 ):
+    quantile = node.Meta.hedge_quantile
+    if quantile is not None and caches:
+        return await _hedged_load(node, caches, miss, metrics, quantile, load_fn)
     serializer = node.get_seriaizer()
     result = sentinel
     for cache in caches:
-        result = await cache.storage.get(node, serializer)
+        cache_metrics = metrics.cache(cache.storage_name)
+        result = await _remote_get(node, cache, serializer, cache_metrics)
+        if result is _failed:
+            result = sentinel
+            continue
         if result is not sentinel:
+            cache_metrics._hit_count += 1
             break
+        cache_metrics._miss_count += 1
         miss.append(cache)
     # load from source
     if result is sentinel:
-        result = await node.load() if load_fn is None else await load_fn(node)
+        result = await _load_source(node, metrics, load_fn)
+
+    return result
+
+
+async def _remote_get(
+    node: Node,
+    cache: Cache,
+    serializer: Optional[Serializer],
+    cache_metrics: CacheMetrics,
+) -> Any:
+    start = time_ns()
+    try:
+        result = await cache.storage.get(node, serializer)
+    except CancelledError:
+        # cancelled by hedging, elapsed time is a lower bound of latency
+        cache_metrics._record_latency(time_ns() - start)
+        raise
+    except Exception:
+        # with circuit breaker, a failed tier is skipped instead of failing request
+        if cache.storage.breaker is None:
+            raise
+        cache_metrics._bypass_count += 1
+        return _failed
+    cache_metrics._record_latency(time_ns() - start)
+    if _hooks:
+        instrumentation.emit(
+            instrumentation.REMOTE, node.__class__, 1, cache.storage_name, start
+        )
+    return result
 
+
+# Skip a remote tier for reads and fills if its circuit breaker is open. With node
+# bypass_slow_tiers, also skip it if its median latency is above average source load
+# time, but let 1 of 16 requests through to keep its latency samples fresh.
+def _skip_tier(node: Node, cache: Cache, metrics: Metrics) -> bool:
+    cache_metrics = metrics.cache(cache.storage_name)
+    if not cache.storage.allow():
+        cache_metrics._bypass_count += 1
+        return True
+    if not node.Meta.bypass_slow_tiers:
+        return False
+    latency = cache_metrics.latency_quantile(0.5)
+    if (
+        latency is None
+        or metrics._source_load_count < cache_metrics.latency_min_samples
+        or latency <= metrics.average_source_load_time()
+    ):
+        return False
+    cache_metrics._slow_checks += 1
+    if cache_metrics._slow_checks % 16 == 0:
+        return False
+    cache_metrics._bypass_count += 1
+    return True
+
+
+async def _load_source(node: Node, metrics: Metrics, load_fn=None) -> Any:
+    start = time_ns()
+    result = await node.load() if load_fn is None else await load_fn(node)
+    metrics._record_load((node.full_key(),), time_ns() - start)
+    if _hooks:
+        instrumentation.emit(instrumentation.LOAD, node.__class__, 1, None, start)
     return result
 
 
+# Same as _load_from_caches, but when latest started step(remote tier) is slower
+# than quantile of its recent latencies, next step(next tier or source load) is
+# started in parallel. First hit wins, other steps are cancelled.
+async def _hedged_load(
+    node: Node,
+    caches: List[Cache],
+    miss: List[Cache],
+    metrics: Metrics,
+    quantile: float,
+    load_fn=None,
+):
+    serializer = node.get_seriaizer()
+    tiers = [metrics.cache(cache.storage_name) for cache in caches]
+    # running step tasks, step index len(caches) is source load
+    tasks: Dict[Future, int] = {}
+    step = -1
+    step_start = 0
+
+    def next_step():
+        nonlocal step, step_start
+        step += 1
+        step_start = time_ns()
+        if step < len(caches):
+            coro = _remote_get(node, caches[step], serializer, tiers[step])
+        else:
+            coro = _load_source(node, metrics, load_fn)
+        tasks[ensure_future(coro)] = step
+
+    next_step()
+    try:
+        while True:
+            timeout = None
+            if step < len(caches):
+                threshold = tiers[step].latency_quantile(quantile)
+                if threshold is not None:
+                    timeout = max(threshold - (time_ns() - step_start), 0) / 1e9
+            done, _ = await wait(
+                tasks.keys(), timeout=timeout, return_when=FIRST_COMPLETED
+            )
+            if not done:
+                tiers[step]._hedge_count += 1
+                next_step()
+                continue
+            for task in sorted(done, key=tasks.__getitem__):
+                index = tasks.pop(task)
+                result = task.result()
+                if index < len(caches):
+                    if result is _failed:
+                        if index == step:
+                            next_step()
+                        continue
+                    if result is sentinel:
+                        tiers[index]._miss_count += 1
+                        miss.append(caches[index])
+                        if index == step:
+                            next_step()
+                        continue
+                    tiers[index]._hit_count += 1
+                # earlier steps still running were beaten by hedged read
+                for pending in tasks.values():
+                    if pending < index:
+                        tiers[pending]._hedge_win_count += 1
+                return result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 async def get_all(nodes: Sequence[Node[R]]) -> List[R]:
     """
     Get data from multiple nodes. Will call load function if cahce miss.
@@ -154,6 +342,7 @@ async def get_all(nodes: Sequence[Node[R]]) -> List[R]:
         return []
     node_cls = nodes[0].__class__
     metrics = nodes[0].get_metrics()
+    metrics._tick()
     pending: Dict[str, Node] = {}
     missing: Dict[Cache, Iterable[Node]] = {}
     caches = nodes[0].get_caches()
@@ -178,11 +367,21 @@ async def get_all(nodes: Sequence[Node[R]]) -> List[R]:
 
     # load from local caches first
     for cache in local_caches:
+        if _hooks:
+            start = time_ns()
+            count = len(pending)
         result = cache.storage.get_all_sync(tuple(pending.values()), None)
+        if _hooks:
+            instrumentation.emit(
+                instrumentation.LOCAL, node_cls, count, cache.storage_name, start
+            )
         for k, v in result:
             pending.pop(k.full_key(), None)
             results[k.full_key()] = v
         missing[cache] = tuple(pending.values())
+        cache_metrics = metrics.cache(cache.storage_name)
+        cache_metrics._hit_count += len(result)
+        cache_metrics._miss_count += len(pending)
 
     # load from remote cache
     fetch: Dict[str, Node] = {}  # missing nodes, need to load from source
@@ -200,6 +399,7 @@ async def get_all(nodes: Sequence[Node[R]]) -> List[R]:
         # update metrics
         metrics._miss_count += len(fetch)
         metrics._hit_count += len(nodes) - len(fetch)
+        metrics._wait_count += len(wait)
 
         if len(fetch) > 0:
             fetcher = Fetcher()
@@ -209,21 +409,56 @@ async def get_all(nodes: Sequence[Node[R]]) -> List[R]:
                 _awaits[key] = future
                 aws.append((key, future))
             fetcher.data = await _get_multi(
-                nodes[0], remote_caches, fetch, missing, metrics
+                nodes[0],
+                [c for c in remote_caches if not _skip_tier(nodes[0], c, metrics)],
+                fetch,
+                missing,
+                metrics,
             )
             # load done, set all events and results
             for aw in aws:
                 aw[1].set_result(fetcher.data[aw[0]])
             for ks, vs in fetcher.data.items():
                 results[ks] = vs
+        hooked = bool(_hooks) and len(wait) > 0
+        start = time_ns() if hooked else 0
         for w in wait:
             results[w[0]] = await w[1]
+        if hooked:
+            instrumentation.emit(instrumentation.WAIT, node_cls, len(wait), None, start)
 
     # fill missing caches
     for cache, missing_nodes in missing.items():
         data = [(node, results[node.full_key()]) for node in missing_nodes]
         if len(data) > 0:
-            await cache.storage.set_all(data, cache.ttl, node_cls.Meta.serializer)
+            cache_metrics = metrics.cache(cache.storage_name)
+            if not cache.storage.allow():
+                cache_metrics._bypass_count += 1
+                continue
+            hooked = bool(_hooks)
+            start = time_ns() if hooked else 0
+            try:
+                await cache.storage.set_all(data, cache.ttl, node_cls.Meta.serializer)
+            except CircuitOpenError:
+                cache_metrics._bypass_count += 1
+                continue
+            except Exception as e:
+                cache_metrics._fill_failure_count += len(data)
+                # failure is recorded by breaker, don't fail request
+                if cache.storage.breaker is not None:
+                    continue
+                for key in fetch:
+                    _awaits.pop(key, None)
+                raise (e)
+            cache_metrics._fill_count += len(data)
+            if hooked:
+                instrumentation.emit(
+                    instrumentation.FILL,
+                    node_cls,
+                    len(data),
+                    cache.storage_name,
+                    start,
+                )
 
     # remove tmp_cache
     for key in fetch:
@@ -243,11 +478,32 @@ async def _get_multi(
     serializer = node.get_seriaizer()
     results: Dict[str, Any] = {}
     for cache in caches:
-        cached = await cache.storage.get_all(list(nodes.values()), serializer)
+        hooked = bool(_hooks)
+        start = time_ns() if hooked else 0
+        count = len(nodes)
+        try:
+            cached = await cache.storage.get_all(list(nodes.values()), serializer)
+        except Exception:
+            # with circuit breaker, a failed tier is skipped instead of failing request
+            if cache.storage.breaker is None:
+                raise
+            metrics.cache(cache.storage_name)._bypass_count += 1
+            continue
+        if hooked:
+            instrumentation.emit(
+                instrumentation.REMOTE,
+                node.__class__,
+                count,
+                cache.storage_name,
+                start,
+            )
         for k, v in cached:
             nodes.pop(k.full_key(), None)
             results[k.full_key()] = v
         missing[cache] = tuple(nodes.values())
+        cache_metrics = metrics.cache(cache.storage_name)
+        cache_metrics._hit_count += len(cached)
+        cache_metrics._miss_count += len(nodes)
 
     # load from source
     if len(nodes) > 0:
@@ -260,8 +516,14 @@ async def _get_multi(
             metrics._load_failure_count += len(nodes)
             metrics._total_load_time += time_ns() - now
             raise (e)
+        if _hooks:
+            instrumentation.emit(
+                instrumentation.LOAD, node.__class__, len(nodes), None, now
+            )
+        duration = time_ns() - now
         metrics._load_success_count += len(nodes)
-        metrics._total_load_time += time_ns() - now
+        metrics._total_load_time += duration
+        metrics._record_load(list(nodes), duration)
     return results
 
 
@@ -345,5 +607,7 @@ def build_node(
     new.Meta.doorkeeper = doorkeeper
     new.Meta.metrics = Metrics()
     _dynamic_nodes[name] = new
-    _add_node(new)
+    # MetaNode registers it already if DynamicNode.Meta has caches
+    if new not in get_nodes():
+        _add_node(new)
     return new
@@ -0,0 +1,75 @@
+from time import time_ns
+from typing import Any, Callable, List, NamedTuple, Optional, Type
+
+from cacheme.interfaces import Node
+
+# cache stages
+LOCAL = "local"  # lookup on a local cache
+REMOTE = "remote"  # lookup on a remote cache
+WAIT = "wait"  # wait for a load already in flight(single-flight join)
+LOAD = "load"  # load from source
+LOADS = "loads"  # deserialize blobs from storage
+DUMPS = "dumps"  # serialize values to storage
+FILL = "fill"  # write back to a missing cache
+
+
+class Event(NamedTuple):
+    stage: str
+    node: Type[Node]
+    # number of keys involved, 1 for get and len(nodes) for get_all
+    keys: int
+    # storage name for cache stages, storage scheme for loads/dumps, None otherwise
+    tier: Optional[str]
+    # start time and duration in nanoseconds
+    start: int
+    duration: int
+
+
+Hook = Callable[[Event], Any]
+
+# hooks are checked by truthiness in hot path, so mutate in place only
+_hooks: List[Hook] = []
+
+
+def add_hook(hook: Hook):
+    """
+    Add a hook, which will be called with an Event after each cache stage.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Hook):
+    _hooks.remove(hook)
+
+
+def emit(stage: str, node: Type[Node], keys: int, tier: Optional[str], start: int):
+    event = Event(stage, node, keys, tier, start, time_ns() - start)
+    for hook in _hooks:
+        hook(event)
+
+
+class OpenTelemetryHook:
+    """
+    Record each event as an OpenTelemetry span, child of current span.
+
+    :param tracer: OpenTelemetry tracer, default tracer named "cacheme" if not set.
+    """
+
+    def __init__(self, tracer: Any = None):
+        if tracer is None:
+            from opentelemetry import trace
+
+            tracer = trace.get_tracer("cacheme")
+        self.tracer = tracer
+
+    def __call__(self, event: Event):
+        attributes = {
+            "cacheme.node": event.node.__qualname__,
+            "cacheme.keys": event.keys,
+        }
+        if event.tier is not None:
+            attributes["cacheme.tier"] = event.tier
+        span = self.tracer.start_span(
+            f"cacheme.{event.stage}", start_time=event.start, attributes=attributes
+        )
+        span.end(end_time=event.start + event.duration)
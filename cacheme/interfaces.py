@@ -1,5 +1,16 @@
-from datetime import datetime, timedelta
-from typing import TYPE_CHECKING, NamedTuple, Optional, Sequence, Tuple, TypeVar, List
+import heapq
+from datetime import timedelta
+from time import monotonic
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 from typing_extensions import Any, Protocol, ClassVar
 
@@ -14,12 +25,71 @@ R = TypeVar("R", covariant=True)
 # - When an exception is thrown while loading an entry,
 # miss_count and load_failure_count are incremented, and the total loading
 # time, in nanoseconds, is added to total_load_time
+# - When a request joins a load already in flight for the same key, wait_count
+# and hit_count are incremented
+# - Counters are cumulative, a snapshot of them is taken on first request of each
+# second and kept for window_size seconds, so window(seconds) can diff against it
+# - The slowest source loads, in nanoseconds, are tracked per key, up to slow_keys_size
+# - source_load_count/total_source_load_time count loads from source only, while
+# load counters above also include loads served by remote caches
 class Metrics:
     _hit_count: int = 0
     _miss_count: int = 0
     _load_success_count: int = 0
     _load_failure_count: int = 0
     _total_load_time: int = 0
+    _wait_count: int = 0
+    _source_load_count: int = 0
+    _total_source_load_time: int = 0
+    window_size: int = 300
+    slow_keys_size: int = 10
+
+    def __init__(self):
+        self._caches: Dict[str, CacheMetrics] = {}
+        self._second = 0
+        # ring buffer of (second, hit, miss, load success, load failure, load time)
+        self._snapshots: List[Optional[Tuple[int, int, int, int, int, int]]] = [
+            None
+        ] * self.window_size
+        # min heap of (load time, key)
+        self._slow_keys: List[Tuple[int, str]] = []
+
+    def _tick(self):
+        now = int(monotonic())
+        if now != self._second:
+            self._second = now
+            self._snapshots[now % len(self._snapshots)] = (
+                now,
+                self._hit_count,
+                self._miss_count,
+                self._load_success_count,
+                self._load_failure_count,
+                self._total_load_time,
+            )
+
+    def _record_load(self, keys: Sequence[str], duration: int):
+        """
+        Record one source load of keys, batch duration is counted once in total.
+        """
+        self._source_load_count += len(keys)
+        self._total_source_load_time += duration
+        for key in keys:
+            self._record_slow_key(key, duration)
+
+    def _record_slow_key(self, key: str, duration: int):
+        slow_keys = self._slow_keys
+        if len(slow_keys) == self.slow_keys_size and duration <= slow_keys[0][0]:
+            return
+        for i, (d, k) in enumerate(slow_keys):
+            if k == key:
+                if duration > d:
+                    slow_keys[i] = (duration, key)
+                    heapq.heapify(slow_keys)
+                return
+        if len(slow_keys) < self.slow_keys_size:
+            heapq.heappush(slow_keys, (duration, key))
+        else:
+            heapq.heapreplace(slow_keys, (duration, key))
 
     def request_count(self) -> int:
         return self._hit_count + self._miss_count
@@ -54,13 +124,169 @@ class Metrics:
     def average_load_time(self) -> float:
         return self._total_load_time / self.load_count()
 
+    def wait_count(self) -> int:
+        return self._wait_count
+
+    def source_load_count(self) -> int:
+        return self._source_load_count
+
+    def average_source_load_time(self) -> float:
+        return self._total_source_load_time / self._source_load_count
+
+    def window(self, seconds: int = 60) -> "WindowMetrics":
+        """
+        Metrics of requests in last N seconds, up to window_size.
+        """
+        seconds = min(seconds, len(self._snapshots))
+        since = int(monotonic()) - seconds + 1
+        oldest = None
+        for snapshot in self._snapshots:
+            if snapshot is not None and snapshot[0] >= since:
+                if oldest is None or snapshot[0] < oldest[0]:
+                    oldest = snapshot
+        if oldest is None:
+            return WindowMetrics(seconds)
+        return WindowMetrics(
+            seconds,
+            self._hit_count - oldest[1],
+            self._miss_count - oldest[2],
+            self._load_success_count - oldest[3],
+            self._load_failure_count - oldest[4],
+            self._total_load_time - oldest[5],
+        )
+
+    def slowest_loads(self) -> List[Tuple[str, int]]:
+        """
+        Slowest source loads as (key, load time in nanoseconds), slowest first.
+        """
+        return [(k, d) for d, k in sorted(self._slow_keys, reverse=True)]
+
+    def cache(self, name: str) -> "CacheMetrics":
+        metrics = self._caches.get(name, None)
+        if metrics is None:
+            metrics = CacheMetrics()
+            self._caches[name] = metrics
+        return metrics
+
+    def caches(self) -> Dict[str, "CacheMetrics"]:
+        return self._caches
+
+
+class WindowMetrics(NamedTuple):
+    seconds: int
+    hit_count: int = 0
+    miss_count: int = 0
+    load_success_count: int = 0
+    load_failure_count: int = 0
+    total_load_time: int = 0
+
+    def request_count(self) -> int:
+        return self.hit_count + self.miss_count
+
+    def hit_rate(self) -> float:
+        return self.hit_count / self.request_count()
+
+    def miss_rate(self) -> float:
+        return self.miss_count / self.request_count()
+
+    def load_count(self) -> int:
+        return self.load_success_count + self.load_failure_count
+
+    def average_load_time(self) -> float:
+        return self.total_load_time / self.load_count()
+
+
+# Metrics of a single cache tier of a node, keyed by storage name in Metrics:
+# - hit_count/miss_count are incremented on each lookup against this tier
+# - fill_count/fill_failure_count are incremented when a missing value is written
+# back to this tier
+# - Latencies of last latency_size remote gets are kept, in nanoseconds, for
+# latency_quantile. A get cancelled by hedging counts as its elapsed time
+# - hedge_count is incremented when this tier is slower than hedge threshold and
+# next tier or source load is started in parallel, hedge_win_count when the
+# hedged read finished first
+# - bypass_count is incremented when this tier is skipped, because its circuit
+# breaker is open, a read failed with breaker enabled, or it's slower than source
+class CacheMetrics:
+    _hit_count: int = 0
+    _miss_count: int = 0
+    _fill_count: int = 0
+    _fill_failure_count: int = 0
+    _hedge_count: int = 0
+    _hedge_win_count: int = 0
+    _bypass_count: int = 0
+    _slow_checks: int = 0
+    latency_size: int = 128
+    latency_min_samples: int = 20
+
+    def __init__(self):
+        self._latencies: List[int] = []
+        self._latency_count = 0
+        # quantile -> (latency count when computed, value)
+        self._quantiles: Dict[float, Tuple[int, int]] = {}
+
+    def _record_latency(self, duration: int):
+        if len(self._latencies) < self.latency_size:
+            self._latencies.append(duration)
+        else:
+            self._latencies[self._latency_count % self.latency_size] = duration
+        self._latency_count += 1
+
+    def request_count(self) -> int:
+        return self._hit_count + self._miss_count
+
+    def hit_count(self) -> int:
+        return self._hit_count
+
+    def hit_rate(self) -> float:
+        return self._hit_count / self.request_count()
+
+    def miss_count(self) -> int:
+        return self._miss_count
+
+    def miss_rate(self) -> float:
+        return self._miss_count / self.request_count()
+
+    def fill_count(self) -> int:
+        return self._fill_count
+
+    def fill_failure_count(self) -> int:
+        return self._fill_failure_count
+
+    def hedge_count(self) -> int:
+        return self._hedge_count
+
+    def hedge_win_count(self) -> int:
+        return self._hedge_win_count
+
+    def bypass_count(self) -> int:
+        return self._bypass_count
+
+    def latency_quantile(self, quantile: float) -> Optional[int]:
+        """
+        Quantile of recent get latencies in nanoseconds, None if not enough samples.
+        """
+        if len(self._latencies) < self.latency_min_samples:
+            return None
+        cached = self._quantiles.get(quantile)
+        # sorting on every call is wasteful, recompute after some new samples
+        if cached is not None and self._latency_count - cached[0] < 16:
+            return cached[1]
+        ordered = sorted(self._latencies)
+        value = ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+        self._quantiles[quantile] = (self._latency_count, value)
+        return value
+
 
 class CachedData(NamedTuple):
     data: Any
-    expire: Optional[datetime] = None
+    # expire time in epoch milliseconds
+    expire: Optional[int] = None
 
 
 class Storage(Protocol):
+    breaker: Optional[Any]
+
     async def connect(self):
         ...
 
@@ -110,6 +336,12 @@ class Storage(Protocol):
     def is_local(self) -> bool:
         ...
 
+    def allow(self) -> bool:
+        ...
+
+    def stats(self) -> Dict[str, float]:
+        ...
+
 
 class Serializer(Protocol):
     def dumps(self, obj: Any) -> bytes:
@@ -147,6 +379,9 @@ class Node(Protocol[R]):
     def key(self) -> str:
         ...
 
+    def hash_tag(self) -> Optional[str]:
+        ...
+
     def full_key(self) -> str:
         ...
 
@@ -178,4 +413,6 @@ class Node(Protocol[R]):
         caches: List["Cache"] = []
         serializer: ClassVar[Optional[Serializer]] = None
         doorkeeper: ClassVar[Optional[DoorKeeper]] = None
+        hedge_quantile: ClassVar[Optional[float]] = None
+        bypass_slow_tiers: ClassVar[bool] = False
         metrics: ClassVar[Metrics]
@@ -42,6 +42,10 @@ def set_prefix(prefix: str):
     _prefix = prefix
 
 
+def get_prefix() -> str:
+    return _prefix
+
+
 class Cache:
     __slots__ = ["_storage", "_storage_name", "ttl", "_is_local"]
 
@@ -51,6 +55,10 @@ class Cache:
         self.ttl: Optional[timedelta] = ttl
         self._is_local: Optional[bool] = None
 
+    @property
+    def storage_name(self) -> str:
+        return self._storage_name
+
     @property
     def is_local(self):
         if self._is_local is None:
@@ -68,7 +76,7 @@ class MetaNode(type):
     def __new__(cls, name, bases, dct):
         new = super().__new__(cls, name, bases, dct)
         if len(new.Meta.caches) > 0:
-            _nodes.append(cast(Type[Node], cls))
+            _nodes.append(cast(Type[Node], new))
             new.Meta.metrics = Metrics()
         return new
 
@@ -84,9 +92,17 @@ class Node(Generic[C], metaclass=MetaNode):
     def key(self) -> str:
         raise NotImplementedError()
 
+    # keys with same hash tag are stored in same redis cluster slot
+    def hash_tag(self) -> Optional[str]:
+        return None
+
     def full_key(self) -> str:
         if self._full_key is None:
-            self._full_key = f"{_prefix}:{self.key()}:{self.Meta.version}"
+            tag = self.hash_tag()
+            if tag is None:
+                self._full_key = f"{_prefix}:{self.key()}:{self.Meta.version}"
+            else:
+                self._full_key = f"{_prefix}:{{{tag}}}:{self.key()}:{self.Meta.version}"
         return self._full_key
 
     async def load(self) -> C:
@@ -121,6 +137,11 @@ class Node(Generic[C], metaclass=MetaNode):
         caches: List[Cache] = []
         serializer: ClassVar[Optional[Serializer]] = None
         doorkeeper: ClassVar[Optional[DoorKeeper]] = None
+        # start next tier or source load when a remote tier is slower than this
+        # quantile of its recent latencies, None to disable hedging
+        hedge_quantile: ClassVar[Optional[float]] = None
+        # skip remote tiers with median latency above average source load time
+        bypass_slow_tiers: ClassVar[bool] = False
         metrics: ClassVar[Metrics]
 
 
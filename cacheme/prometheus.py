@@ -0,0 +1,165 @@
+import asyncio
+from typing import Dict, List, Tuple, Type
+
+from cacheme.core import _awaits_len, nodes
+from cacheme.data import list_storages
+from cacheme.interfaces import Node
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# (name, type, help) of node level metric families
+_NODE_FAMILIES: List[Tuple[str, str, str]] = [
+    ("cacheme_hits_total", "counter", "Cache hits, including single-flight waits."),
+    ("cacheme_misses_total", "counter", "Cache misses."),
+    ("cacheme_waits_total", "counter", "Requests joined an in-flight load."),
+    (
+        "cacheme_load_success_total",
+        "counter",
+        "Successful loads, including remote cache hits.",
+    ),
+    ("cacheme_load_failure_total", "counter", "Failed loads from source."),
+    (
+        "cacheme_load_seconds_total",
+        "counter",
+        "Total time spent loading, including remote cache hits.",
+    ),
+    ("cacheme_source_loads_total", "counter", "Successful loads from source."),
+    (
+        "cacheme_source_load_seconds_total",
+        "counter",
+        "Total time spent loading from source.",
+    ),
+]
+
+# (name, type, help) of cache tier level metric families
+_CACHE_FAMILIES: List[Tuple[str, str, str]] = [
+    ("cacheme_cache_hits_total", "counter", "Hits on a cache tier."),
+    ("cacheme_cache_misses_total", "counter", "Misses on a cache tier."),
+    ("cacheme_cache_fills_total", "counter", "Values written back to a cache tier."),
+    (
+        "cacheme_cache_fill_failures_total",
+        "counter",
+        "Failed writes back to a cache tier.",
+    ),
+    (
+        "cacheme_cache_hedges_total",
+        "counter",
+        "Hedged reads started because a cache tier was slow.",
+    ),
+    (
+        "cacheme_cache_hedge_wins_total",
+        "counter",
+        "Hedged reads finished before the slow cache tier.",
+    ),
+    (
+        "cacheme_cache_bypasses_total",
+        "counter",
+        "Cache tier skipped by circuit breaker or slow tier bypass.",
+    ),
+]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _node_name(node: Type[Node]) -> str:
+    return _escape(f"{node.__module__}.{node.__qualname__}")
+
+
+def _header(lines: List[str], name: str, type_: str, help_: str):
+    lines.append(f"# HELP {name} {help_}")
+    lines.append(f"# TYPE {name} {type_}")
+
+
+def render() -> str:
+    """
+    Render metrics of all registered nodes and storages in Prometheus text format.
+    """
+    node_samples: List[List[str]] = [[] for _ in _NODE_FAMILIES]
+    cache_samples: List[List[str]] = [[] for _ in _CACHE_FAMILIES]
+    for node in nodes():
+        metrics = node.get_metrics()
+        label = f'node="{_node_name(node)}"'
+        node_samples[0].append(f"{{{label}}} {metrics._hit_count}")
+        node_samples[1].append(f"{{{label}}} {metrics._miss_count}")
+        node_samples[2].append(f"{{{label}}} {metrics._wait_count}")
+        node_samples[3].append(f"{{{label}}} {metrics._load_success_count}")
+        node_samples[4].append(f"{{{label}}} {metrics._load_failure_count}")
+        node_samples[5].append(f"{{{label}}} {metrics._total_load_time / 1e9}")
+        node_samples[6].append(f"{{{label}}} {metrics._source_load_count}")
+        node_samples[7].append(f"{{{label}}} {metrics._total_source_load_time / 1e9}")
+        for tier, cache_metrics in metrics.caches().items():
+            cache_label = f'{label},storage="{_escape(tier)}"'
+            cache_samples[0].append(f"{{{cache_label}}} {cache_metrics._hit_count}")
+            cache_samples[1].append(f"{{{cache_label}}} {cache_metrics._miss_count}")
+            cache_samples[2].append(f"{{{cache_label}}} {cache_metrics._fill_count}")
+            cache_samples[3].append(
+                f"{{{cache_label}}} {cache_metrics._fill_failure_count}"
+            )
+            cache_samples[4].append(f"{{{cache_label}}} {cache_metrics._hedge_count}")
+            cache_samples[5].append(
+                f"{{{cache_label}}} {cache_metrics._hedge_win_count}"
+            )
+            cache_samples[6].append(f"{{{cache_label}}} {cache_metrics._bypass_count}")
+
+    lines: List[str] = []
+    for (name, type_, help_), samples in zip(
+        _NODE_FAMILIES + _CACHE_FAMILIES, node_samples + cache_samples
+    ):
+        _header(lines, name, type_, help_)
+        lines.extend(name + sample for sample in samples)
+
+    storage_samples: Dict[str, List[str]] = {}
+    for storage_name, storage in list_storages().items():
+        label = f'{{storage="{_escape(storage_name)}"}}'
+        for stat, value in storage.stats().items():
+            storage_samples.setdefault(stat, []).append(f"{label} {value}")
+    for stat, samples in storage_samples.items():
+        name = f"cacheme_storage_{stat}"
+        _header(lines, name, "gauge", f"Storage {stat.replace('_', ' ')}.")
+        lines.extend(name + sample for sample in samples)
+
+    _header(lines, "cacheme_inflight_loads", "gauge", "Loads in flight.")
+    lines.append(f"cacheme_inflight_loads {_awaits_len()}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+async def _handle(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path: str
+):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        parts = request.split(b" ", 2)
+        if len(parts) < 2 or parts[0] != b"GET":
+            status, body, content_type = "405 Method Not Allowed", b"", "text/plain"
+        elif parts[1].split(b"?", 1)[0].decode() != path:
+            status, body, content_type = "404 Not Found", b"", "text/plain"
+        else:
+            status, body, content_type = "200 OK", render().encode(), CONTENT_TYPE
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(
+    port: int, host: str = "0.0.0.0", path: str = "/metrics"
+) -> asyncio.AbstractServer:
+    """
+    Serve rendered metrics over HTTP on running event loop.
+
+    :param port: port to listen on.
+    :param host: host to bind, default all interfaces.
+    :param path: metrics path, default /metrics.
+    """
+    return await asyncio.start_server(
+        lambda r, w: _handle(r, w, path), host=host, port=port
+    )
@@ -2,15 +2,16 @@ import base64
 import importlib
 import json
 import pickle
+import struct
 import zlib
 from types import ModuleType
-from typing import Any, Dict, cast
+from typing import Any, Callable, Dict, List, Optional, Sequence, Type, Union, cast
 
-import msgpack
-import pydantic
-from pydantic.json import pydantic_encoder
 from typing_extensions import Protocol
 
+# msgpack and pydantic are imported on first use, so importing cacheme stays fast
+# when they are not needed, such as local only or pickle serializer
+
 
 class Serializer(Protocol):
     def dumps(self, obj: Any) -> bytes:
@@ -49,6 +50,8 @@ def from_qualified_name(name: str) -> Any:
 
 
 def object_encoder(obj: Any) -> Any:
+    from pydantic.json import pydantic_encoder
+
     return {
         "__class__": to_qualified_name(obj.__class__),
         "data": pydantic_encoder(obj),
@@ -57,6 +60,8 @@ def object_encoder(obj: Any) -> Any:
 
 def object_decoder(result: dict):
     if "__class__" in result:
+        import pydantic
+
         return pydantic.parse_obj_as(
             from_qualified_name(result["__class__"]), result["data"]
         )
@@ -72,24 +77,122 @@ class PickleSerializer:
         return pickle.loads(base64.decodebytes(blob))
 
 
+# BinaryPickleSerializer payload is plain pickle, which starts with PROTO opcode 0x80,
+# or a frame starting with one of markers below:
+# - _FRAMED: buffer count, pickle length, buffer lengths, then pickle and buffers
+# - _BYTES/_BYTEARRAY: large top level value itself
+_FRAMED = 0
+_BYTES = 1
+_BYTEARRAY = 2
+_FRAME_HEADER = struct.Struct("<BIQ")
+_LENGTH = struct.Struct("<Q")
+
+
+class BinaryPickleSerializer:
+    """
+    Pickle protocol 5 without base64, requires python 3.8+. Buffers of at least
+    buffer_threshold bytes are carried out-of-band in a framed payload, instead of
+    being copied into pickle stream: top level bytes/bytearray and PickleBuffer
+    objects, such as NumPy arrays. loads accepts memoryview, out-of-band buffers
+    are views of input without copying.
+
+    :param buffer_threshold: min bytes of buffer to carry out-of-band, None to disable.
+    """
+
+    accepts_buffer = True
+
+    def __init__(self, buffer_threshold: Optional[int] = 64 * 1024):
+        if pickle.HIGHEST_PROTOCOL < 5:
+            raise Exception("pickle protocol 5 requires python 3.8+")
+        self.buffer_threshold = buffer_threshold
+
+    def dumps(self, obj: Any) -> bytes:
+        threshold = self.buffer_threshold
+        if threshold is None:
+            return pickle.dumps(obj, protocol=5)
+        # nested bytes are pickled in-band, hooking every object to find them
+        # makes pickling several times slower
+        if type(obj) is bytes and len(obj) >= threshold:
+            return b"".join([bytes((_BYTES,)), obj])
+        if type(obj) is bytearray and len(obj) >= threshold:
+            return b"".join([bytes((_BYTEARRAY,)), obj])
+        buffers: List[memoryview] = []
+
+        def callback(buffer: Any) -> bool:
+            view = buffer.raw()
+            if view.nbytes < threshold:
+                return True
+            buffers.append(view)
+            return False
+
+        data = pickle.dumps(obj, protocol=5, buffer_callback=callback)
+        if not buffers:
+            return data
+        header = [_FRAME_HEADER.pack(_FRAMED, len(buffers), len(data))]
+        header.extend(_LENGTH.pack(b.nbytes) for b in buffers)
+        return b"".join([*header, data, *buffers])
+
+    def loads(self, blob: Union[bytes, memoryview]) -> Any:
+        view = memoryview(blob)
+        marker = view[0]
+        if marker == _BYTES:
+            return bytes(view[1:])
+        if marker == _BYTEARRAY:
+            return bytearray(view[1:])
+        if marker != _FRAMED:
+            return pickle.loads(view)
+        _, count, length = _FRAME_HEADER.unpack_from(view)
+        offset = _FRAME_HEADER.size
+        lengths = [
+            _LENGTH.unpack_from(view, offset + i * _LENGTH.size)[0]
+            for i in range(count)
+        ]
+        offset += count * _LENGTH.size
+        data = view[offset : offset + length]
+        offset += length
+        buffers = []
+        for size in lengths:
+            buffers.append(view[offset : offset + size])
+            offset += size
+        return pickle.loads(data, buffers=buffers)
+
+
 class JSONSerializer:
+    accepts_buffer = True
+
     def dumps(self, obj: Any) -> bytes:
         return json.dumps(obj, default=object_encoder).encode()
 
     def loads(self, blob: bytes) -> Any:
-        return json.loads(blob.decode(), object_hook=object_decoder)
+        return json.loads(str(blob, "utf-8"), object_hook=object_decoder)
+
+
+_msgpack_module: Any = None
+
+
+def _msgpack() -> Any:
+    # resolved once, import statement in every call costs a lookup of sys.modules
+    global _msgpack_module
+    if _msgpack_module is None:
+        import msgpack
+
+        _msgpack_module = msgpack
+    return _msgpack_module
 
 
 class MsgPackSerializer:
+    accepts_buffer = True
+
     def dumps(self, obj: Any) -> bytes:
-        return cast(bytes, msgpack.dumps(obj, default=object_encoder))
+        return cast(bytes, _msgpack().dumps(obj, default=object_encoder))
 
     def loads(self, blob: bytes) -> Any:
-        return msgpack.loads(blob, object_hook=object_decoder, strict_map_key=False)
+        return _msgpack().loads(blob, object_hook=object_decoder, strict_map_key=False)
 
 
 class CompressedSerializer:
     serializer: Serializer
+    accepts_buffer = True
 
     def dumps(self, obj: Any) -> bytes:
         blob = self.serializer.dumps(obj)
@@ -100,6 +203,319 @@ class CompressedSerializer:
         return self.serializer.loads(uncompressed)
 
 
+class Codec(Protocol):
+    # stored in payload header, 1-119, 0 is uncompressed and 0x78 is legacy zlib
+    id: int
+
+    def compress(self, data: bytes) -> bytes:
+        ...
+
+    def decompress(self, data: bytes) -> bytes:
+        ...
+
+
+class ZlibCodec:
+    id = 1
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, level=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class LZ4Codec:
+    id = 2
+
+    def __init__(self):
+        # lz4 is optional, fail on creation instead of first write
+        import lz4.frame
+
+        self._lz4 = lz4.frame
+
+    def compress(self, data: bytes) -> bytes:
+        return self._lz4.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._lz4.decompress(data)
+
+
+class ZstdCodec:
+    id = 3
+
+    def __init__(self, level: int = 3):
+        # zstandard is optional, fail on creation instead of first write
+        import zstandard
+
+        self.level = level
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+# codec id -> codec class, used to decode payloads written with any codec
+_builtin_codecs: List[Type[Codec]] = [ZlibCodec, LZ4Codec, ZstdCodec]
+_codec_classes: Dict[int, Type[Codec]] = {c.id: c for c in _builtin_codecs}
+_codecs: Dict[int, Codec] = {}
+
+_UNCOMPRESSED = 0
+_LEGACY_ZLIB = 0x78
+
+
+def register_codec(codec: Any):
+    """
+    Register a codec class, so payloads written with it can be decoded.
+    """
+    if not 0 < codec.id < _LEGACY_ZLIB:
+        raise Exception(f"invalid codec id: {codec.id}")
+    if _codec_classes.get(codec.id, codec) is not codec:
+        raise Exception(f"duplicate codec id: {codec.id}")
+    _codec_classes[codec.id] = codec
+
+
+def _codec(id: int) -> Codec:
+    codec = _codecs.get(id)
+    if codec is None:
+        cls = _codec_classes.get(id)
+        if cls is None:
+            raise Exception(f"unknown codec id: {id}")
+        codec = _codecs[id] = cls()
+    return codec
+
+
+class AdaptiveCompressedSerializer:
+    """
+    Compress serialized values of at least min_size bytes, keep them uncompressed
+    if compressed size is above max_ratio of original. Payload starts with codec
+    id byte(0 for uncompressed), so codec can be changed without flushing caches.
+    Payloads of CompressedSerializer(zlib) are still readable.
+
+    :param serializer: serializer of values.
+    :param codec: ZlibCodec, LZ4Codec, ZstdCodec or registered custom codec, default ZlibCodec(level=3).
+    :param min_size: min serialized size in bytes to compress, default 256.
+    :param max_ratio: max compressed/original size ratio to keep compressed, default 0.9.
+    """
+
+    def __init__(
+        self,
+        serializer: Serializer,
+        codec: Optional[Codec] = None,
+        min_size: int = 256,
+        max_ratio: float = 0.9,
+    ):
+        self.serializer = serializer
+        self.codec = codec if codec is not None else ZlibCodec()
+        self.min_size = min_size
+        self.max_ratio = max_ratio
+        self._header = bytes((self.codec.id,))
+
+    def dumps(self, obj: Any) -> bytes:
+        blob = self.serializer.dumps(obj)
+        if len(blob) >= self.min_size:
+            compressed = self.codec.compress(blob)
+            if len(compressed) <= len(blob) * self.max_ratio:
+                return self._header + compressed
+        return b"\x00" + blob
+
+    def loads(self, blob: bytes) -> Any:
+        header = blob[0]
+        if header == _UNCOMPRESSED:
+            return self.serializer.loads(blob[1:])
+        if header == _LEGACY_ZLIB:
+            return self.serializer.loads(zlib.decompress(blob))
+        if header == self.codec.id:
+            return self.serializer.loads(self.codec.decompress(blob[1:]))
+        return self.serializer.loads(_codec(header).decompress(blob[1:]))
+
+
+# DictionaryCompressedSerializer payload kinds, dictionary kinds are followed by
+# dictionary id, then compressed data
+_DICT_RAW = 0
+_DICT_ZLIB = 1
+_DICT_ZLIB_DICT = 2
+_DICT_ZSTD_DICT = 3
+_DICT_ID = struct.Struct("<I")
+
+
+class UnknownDictionaryError(ValueError):
+    """
+    Value is compressed with a dictionary not added to serializer.
+    """
+
+
+def dictionary_id(data: bytes) -> int:
+    return zlib.crc32(data)
+
+
+class DictionaryCompressedSerializer:
+    """
+    Compress small values of same shape with a shared dictionary. Dictionary id(crc32
+    of dictionary) is stored in payload header, so all dictionaries added are
+    readable, rolling to a new dictionary doesn't need a flush. loads raises
+    UnknownDictionaryError for values compressed with an unknown dictionary, which
+    storages treat as miss.
+    Use one instance per node class. With train_samples, first serialized values are
+    sampled to build a dictionary in this process, other processes sharing storage
+    can't read values compressed with it until it's persisted with on_train and
+    passed in dictionaries on their start.
+
+    :param serializer: serializer of values.
+    :param dictionaries: known dictionaries, last one is used for compression.
+    :param codec: zlib(zdict) or zstd(requires zstandard), default zlib.
+    :param level: compression level, default 3.
+    :param dict_size: max dictionary size in bytes, default 32KB(zlib window size).
+    :param train_samples: values to sample before training, default 0(disabled).
+    :param on_train: called with dictionary id and data after training.
+    """
+
+    def __init__(
+        self,
+        serializer: Serializer,
+        dictionaries: Optional[Sequence[bytes]] = None,
+        codec: str = "zlib",
+        level: int = 3,
+        dict_size: int = 32 * 1024,
+        train_samples: int = 0,
+        on_train: Optional[Callable[[int, bytes], Any]] = None,
+    ):
+        if codec not in ("zlib", "zstd"):
+            raise Exception(f"unknown dictionary codec: {codec}")
+        if codec == "zstd":
+            # zstandard is optional, fail on creation instead of first write
+            import zstandard
+
+            self._zstd = zstandard
+        self.serializer = serializer
+        self.codec = codec
+        self.level = level
+        self.dict_size = dict_size
+        self.train_samples = train_samples
+        self.on_train = on_train
+        self._samples: List[bytes] = []
+        # id -> decompress function
+        self._decoders: Dict[int, Callable[[bytes], bytes]] = {}
+        self._active: Optional[int] = None
+        self._compress: Callable[[bytes], bytes] = self._compress_plain
+        self._training = train_samples > 0
+        for data in dictionaries or []:
+            self.add_dictionary(data)
+
+    def add_dictionary(self, data: bytes, active: bool = True) -> int:
+        """
+        Add a dictionary for reads, and use it for writes if active.
+        """
+        id = dictionary_id(data)
+        header = bytes((_DICT_ZSTD_DICT if self.codec == "zstd" else _DICT_ZLIB_DICT,))
+        header += _DICT_ID.pack(id)
+        if self.codec == "zstd":
+            d = self._zstd.ZstdCompressionDict(data)
+            compressor = self._zstd.ZstdCompressor(level=self.level, dict_data=d)
+            decompressor = self._zstd.ZstdDecompressor(dict_data=d)
+
+            def compress(blob: bytes) -> bytes:
+                return header + compressor.compress(blob)
+
+            self._decoders[id] = decompressor.decompress
+        else:
+            # priming zlib with dictionary is costly, copy a primed one instead
+            primed = zlib.compressobj(self.level, zdict=data)
+
+            def compress(blob: bytes) -> bytes:
+                c = primed.copy()
+                return header + c.compress(blob) + c.flush()
+
+            def decompress(blob: bytes) -> bytes:
+                d = zlib.decompressobj(zdict=data)
+                return d.decompress(blob) + d.flush()
+
+            self._decoders[id] = decompress
+        if active:
+            self._active = id
+            self._compress = compress
+            self._training = False
+            self._samples = []
+        return id
+
+    def remove_dictionary(self, id: int):
+        """
+        Remove a dictionary no longer used by cached values.
+        """
+        if id == self._active:
+            raise Exception("can't remove active dictionary")
+        self._decoders.pop(id, None)
+
+    def retrain(self):
+        """
+        Sample values again and train a new dictionary, for example after value
+        shape changed. Current dictionary is used until new one is trained.
+        """
+        if self.train_samples == 0:
+            raise Exception("training is disabled")
+        self._samples = []
+        self._training = True
+
+    def train(self, samples: Sequence[bytes]) -> bytes:
+        """
+        Build a dictionary from serialized samples.
+        """
+        if self.codec == "zstd":
+            return self._zstd.train_dictionary(self.dict_size, samples).as_bytes()
+        # zlib has no training, use recent distinct samples as dictionary, common
+        # strings are found by deflate and most recent ones are closest to data
+        selected: List[bytes] = []
+        size = 0
+        for sample in reversed(list(dict.fromkeys(samples))):
+            if size + len(sample) > self.dict_size:
+                break
+            selected.append(sample)
+            size += len(sample)
+        return b"".join(reversed(selected))
+
+    def _compress_plain(self, blob: bytes) -> bytes:
+        return bytes((_DICT_ZLIB,)) + zlib.compress(blob, level=self.level)
+
+    def _sample(self, blob: bytes):
+        self._samples.append(blob)
+        if len(self._samples) < self.train_samples:
+            return
+        data = self.train(self._samples)
+        id = self.add_dictionary(data)
+        if self.on_train is not None:
+            self.on_train(id, data)
+
+    def dumps(self, obj: Any) -> bytes:
+        blob = self.serializer.dumps(obj)
+        if self._training:
+            self._sample(blob)
+        compressed = self._compress(blob)
+        if len(compressed) >= len(blob) + 1:
+            return bytes((_DICT_RAW,)) + blob
+        return compressed
+
+    def loads(self, blob: bytes) -> Any:
+        kind = blob[0]
+        if kind == _DICT_RAW:
+            return self.serializer.loads(blob[1:])
+        if kind == _DICT_ZLIB:
+            return self.serializer.loads(zlib.decompress(blob[1:]))
+        if kind == _LEGACY_ZLIB:
+            return self.serializer.loads(zlib.decompress(blob))
+        id = _DICT_ID.unpack_from(blob, 1)[0]
+        decoder = self._decoders.get(id)
+        if decoder is None:
+            # trained by another process, storages treat it as miss and load again
+            raise UnknownDictionaryError(f"unknown compression dictionary: {id}")
+        return self.serializer.loads(decoder(blob[1 + _DICT_ID.size :]))
+
+
 class CompressedPickleSerializer(CompressedSerializer):
     serializer: Serializer = PickleSerializer()
 
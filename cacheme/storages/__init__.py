@@ -1,28 +1,41 @@
 import importlib
 from datetime import timedelta
-from typing import Any, Optional, Sequence, Tuple
+from time import monotonic
+from typing import Any, Coroutine, Dict, Optional, Sequence, Tuple, TypeVar
 from urllib.parse import urlparse
 
 from cacheme.interfaces import Node
 from cacheme.serializer import Serializer
 from cacheme.storages.base import BaseStorage
+from cacheme.storages.breaker import CircuitBreaker, CircuitOpenError
+from cacheme.storages.offload import OffloadPolicy
+
+T = TypeVar("T")
 
 
 class Storage:
     SUPPORTED_STORAGES = {
         "local": "cacheme.storages.local:LocalStorage",
+        "disk": "cacheme.storages.disk:DiskStorage",
         "redis": "cacheme.storages.redis:RedisStorage",
         "sqlite": "cacheme.storages.sqlite:SQLiteStorage",
         "mongodb": "cacheme.storages.mongo:MongoStorage",
         "postgresql": "cacheme.storages.postgres:PostgresStorage",
         "mysql": "cacheme.storages.mysql:MySQLStorage",
+        "sharded": "cacheme.storages.sharded:ShardedStorage",
         "sqlite": "cacheme.storages.sqlite:SQLiteStorage",
     }
 
-    def __init__(self, url: str, **options: Any):
+    def __init__(
+        self,
+        url: str,
+        breaker: Optional[CircuitBreaker] = None,
+        offload: Optional[OffloadPolicy] = None,
+        **options: Any,
+    ):
         u = urlparse(url)
         self._scheme = u.scheme
-        self._is_local = True if self._scheme == "local" else False
+        self._is_local = self._scheme in ("local", "disk")
 
         name = self.SUPPORTED_STORAGES.get(u.scheme)
         if name is None:
@@ -30,6 +43,13 @@ class Storage:
         storage_cls = self.__import(name)
         assert issubclass(storage_cls, BaseStorage)
         self._storage = storage_cls(address=url, **options)
+        if breaker is not None and self._is_local:
+            raise Exception("circuit breaker is not supported on local storage")
+        if offload is not None and self._is_local:
+            raise Exception("offload is not supported on local storage")
+        self.breaker = breaker
+        self.offload = offload
+        self._storage.offload = offload
 
     def scheme(self) -> str:
         return self._scheme
@@ -37,6 +57,34 @@ class Storage:
     def is_local(self) -> bool:
         return self._is_local
 
+    def allow(self) -> bool:
+        """
+        False if circuit breaker is open, then storage is skipped for reads and fills.
+        """
+        return self.breaker is None or self.breaker.allow()
+
+    async def _call(self, aw: Coroutine[Any, Any, T]) -> T:
+        breaker = self.breaker
+        if breaker is None:
+            return await aw
+        # callers checked allow() before, but other requests may have opened breaker
+        # or started half open probe since, claim is checked and taken without await
+        if not breaker.start():
+            aw.close()
+            raise CircuitOpenError("circuit breaker is open")
+        start = monotonic()
+        try:
+            result = await aw
+        except Exception:
+            breaker.record(monotonic() - start, False)
+            raise
+        except BaseException:
+            # cancelled, for example by hedging
+            breaker.cancel()
+            raise
+        breaker.record(monotonic() - start, True)
+        return result
+
     def __import(self, name: str) -> Any:
         mod_name, attr_name = name.rsplit(":", 1)
         module = importlib.import_module(mod_name)
@@ -46,12 +94,12 @@ class Storage:
         await self._storage.connect()
 
     async def get(self, node: Node, serializer: Optional[Serializer]) -> Any:
-        return await self._storage.get(node, serializer)
+        return await self._call(self._storage.get(node, serializer))
 
     async def get_all(
         self, nodes: Sequence[Node], serializer: Optional[Serializer]
     ) -> Sequence[Tuple[Node, Any]]:
-        return await self._storage.get_all(nodes, serializer)
+        return await self._call(self._storage.get_all(nodes, serializer))
 
     async def set(
         self,
@@ -60,7 +108,7 @@ class Storage:
         ttl: Optional[timedelta],
         serializer: Optional[Serializer],
     ):
-        return await self._storage.set(node, value, ttl, serializer)
+        return await self._call(self._storage.set(node, value, ttl, serializer))
 
     async def remove(self, node: Node):
         return await self._storage.remove(node)
@@ -71,11 +119,19 @@ class Storage:
         ttl: Optional[timedelta],
         serializer: Optional[Serializer],
     ):
-        return await self._storage.set_all(data, ttl, serializer)
+        return await self._call(self._storage.set_all(data, ttl, serializer))
 
     async def close(self):
         return await self._storage.close()
 
+    def stats(self) -> Dict[str, float]:
+        stats = self._storage.stats()
+        if self.breaker is not None:
+            stats = {**stats, **self.breaker.stats()}
+        if self.offload is not None:
+            stats = {**stats, **self.offload.stats()}
+        return stats
+
     # local storage only
     def get_sync(self, node: Node, serializer: Optional[Serializer]) -> Any:
         return self._storage.get_sync(node, serializer)
@@ -85,3 +141,11 @@ class Storage:
         self, nodes: Sequence[Node], serializer: Optional[Serializer]
     ) -> Sequence[Tuple[Node, Any]]:
         return self._storage.get_all_sync(nodes, serializer)
+
+    # sharded storage only
+    async def add_shard(self, shard: Any, name: Optional[str] = None):
+        return await self._storage.add_shard(shard, name)
+
+    # sharded storage only
+    async def remove_shard(self, name: str):
+        return await self._storage.remove_shard(name)
@@ -1,16 +1,68 @@
+import asyncio
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Sequence, Tuple, cast
+from time import time_ns
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    cast,
+)
+from urllib.parse import urlparse
 
 from typing_extensions import Any
 
+from cacheme import instrumentation
+from cacheme.instrumentation import _hooks
 from cacheme.interfaces import CachedData, Node
 from cacheme.models import sentinel
-from cacheme.serializer import Serializer
+from cacheme.serializer import Serializer, UnknownDictionaryError
+
+if TYPE_CHECKING:
+    from cacheme.storages.offload import OffloadPolicy
+
+
+def now_ms() -> int:
+    return time_ns() // 1_000_000
+
+
+def epoch_ms(dt: datetime) -> int:
+    """
+    Convert datetime to epoch milliseconds, naive datetime is treated as UTC.
+    """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def expire_at(ttl: Optional[timedelta], epoch: bool) -> Any:
+    """
+    Expire value of ttl from now, epoch milliseconds if epoch is True, otherwise datetime.
+    """
+    if ttl is None:
+        return None
+    if epoch:
+        return now_ms() + int(ttl.total_seconds() * 1000)
+    return datetime.now(timezone.utc) + ttl
+
+
+def now_value(epoch: bool) -> Any:
+    if epoch:
+        return now_ms()
+    return datetime.now(timezone.utc)
 
 
 class BaseStorage:
+    # set by Storage, (de)serialize large payloads in pool
+    offload: Optional["OffloadPolicy"] = None
+
     def __init__(self, address: str, *args, **kwargs):
         self.address = address
+        self._scheme = urlparse(address).scheme
 
     async def connect(self):
         raise NotImplementedError()
@@ -40,23 +92,45 @@ class BaseStorage:
     ) -> Sequence[Tuple[Node, Any]]:
         raise NotImplementedError()
 
+    # key passed to *_by_key(s) methods, storages with custom layout can override
+    def storage_key(self, node: Node) -> Any:
+        return node.full_key()
+
     def serialize(self, raw: Any, serializer: Optional[Serializer]) -> CachedData:
         data = raw["value"]
         if serializer is not None:
             data = serializer.loads(cast(bytes, raw["value"]))
+        expire = raw["expire"]
+        if expire is not None and not isinstance(expire, int):
+            expire = epoch_ms(expire)
         return CachedData(
             data=data,
-            expire=raw["expire"],
+            expire=expire,
         )
 
     async def get(self, node: Node, serializer: Optional[Serializer]) -> Any:
-        result = await self.get_by_key(node.full_key())
+        result = await self.get_by_key(self.storage_key(node))
         if result is None:
             return sentinel
-        data = self.serialize(result, serializer)
-        if data.expire is not None and data.expire.replace(
-            tzinfo=timezone.utc
-        ) <= datetime.now(timezone.utc):
+        # hooks may be added while offloaded, check snapshot of stage start
+        hooked = bool(_hooks)
+        start = time_ns() if hooked else 0
+        offload = self.offload
+        if (
+            offload is not None
+            and serializer is not None
+            and offload.offload_loads(result)
+        ):
+            data = await offload.run(self._decode, result, serializer)
+        else:
+            data = self._decode(result, serializer)
+        if hooked:
+            instrumentation.emit(
+                instrumentation.LOADS, node.__class__, 1, self._scheme, start
+            )
+        if data is None:
+            return sentinel
+        if data.expire is not None and data.expire <= now_ms():
             return sentinel
         return data.data
 
@@ -73,11 +147,26 @@ class BaseStorage:
         ttl: Optional[timedelta],
         serializer: Optional[Serializer],
     ):
-        v = self.deserialize(value, serializer)
-        await self.set_by_key(node.full_key(), v, ttl)
+        hooked = bool(_hooks)
+        start = time_ns() if hooked else 0
+        offload = self.offload
+        if offload is None or serializer is None:
+            v = self.deserialize(value, serializer)
+        else:
+            node_cls = node.__class__
+            if offload.offload_dumps(node_cls):
+                v = await offload.run(self.deserialize, value, serializer)
+            else:
+                v = self.deserialize(value, serializer)
+            offload.record_dumps(node_cls, v)
+        if hooked:
+            instrumentation.emit(
+                instrumentation.DUMPS, node.__class__, 1, self._scheme, start
+            )
+        await self.set_by_key(self.storage_key(node), v, ttl)
 
     async def remove(self, node: Node):
-        await self.remove_by_key(node.full_key())
+        await self.remove_by_key(self.storage_key(node))
 
     async def get_all(
         self,
@@ -90,22 +179,95 @@ class BaseStorage:
         mapping = {}
         keys = []
         for node in nodes:
-            key = node.full_key()
+            key = self.storage_key(node)
             keys.append(key)
             mapping[key] = node
         gets = await self.get_by_keys(keys)
-        for k, v in gets.items():
-            node = mapping[k]
-            if v is None:
+        hooked = bool(_hooks) and len(gets) > 0
+        start = time_ns() if hooked else 0
+        now = now_ms()
+        offload = self.offload
+        decoded: Iterable[Tuple[str, Optional[CachedData]]]
+        if offload is not None and serializer is not None:
+            decoded = await self._serialize_offload(offload, gets, serializer)
+        else:
+            decoded = (
+                (k, self._decode(v, serializer))
+                for k, v in gets.items()
+                if v is not None
+            )
+        for k, data in decoded:
+            if data is None:
                 continue
-            data = self.serialize(v, serializer)
-            if data.expire is not None and data.expire.replace(
-                tzinfo=timezone.utc
-            ) <= datetime.now(timezone.utc):
+            if data.expire is not None and data.expire <= now:
                 continue
-            results.append((node, data.data))
+            results.append((mapping[k], data.data))
+        if hooked:
+            instrumentation.emit(
+                instrumentation.LOADS,
+                nodes[0].__class__,
+                len(gets),
+                self._scheme,
+                start,
+            )
         return results
 
+    def _decode(
+        self, raw: Any, serializer: Optional[Serializer]
+    ) -> Optional[CachedData]:
+        """
+        Serialize raw value, None if serializer can't decode it and it's a miss.
+        """
+        try:
+            return self.serialize(raw, serializer)
+        except UnknownDictionaryError:
+            # compressed with a dictionary trained by another process
+            return None
+
+    def _serialize_chunk(
+        self, raws: List[Any], serializer: Serializer
+    ) -> List[Optional[CachedData]]:
+        return [self._decode(raw, serializer) for raw in raws]
+
+    async def _serialize_offload(
+        self, offload: "OffloadPolicy", gets: Dict[str, Any], serializer: Serializer
+    ) -> Iterable[Tuple[str, Optional[CachedData]]]:
+        keys = [k for k, v in gets.items() if v is not None]
+        raws = [gets[k] for k in keys]
+        chunks = offload.chunks(raws)
+        if chunks is None:
+            return zip(keys, self._serialize_chunk(raws, serializer))
+        parts = await asyncio.gather(
+            *[offload.run(self._serialize_chunk, chunk, serializer) for chunk in chunks]
+        )
+        return zip(keys, (data for part in parts for data in part))
+
+    def _deserialize_chunk(
+        self, values: Sequence[Any], serializer: Serializer
+    ) -> List[Any]:
+        return [self.deserialize(value, serializer) for value in values]
+
+    async def _deserialize_offload(
+        self,
+        offload: "OffloadPolicy",
+        node_cls: Type[Node],
+        values: Sequence[Any],
+        serializer: Serializer,
+    ) -> List[Any]:
+        chunks = offload.dumps_chunks(node_cls, values)
+        if chunks is None:
+            blobs = self._deserialize_chunk(values, serializer)
+        else:
+            parts = await asyncio.gather(
+                *[
+                    offload.run(self._deserialize_chunk, chunk, serializer)
+                    for chunk in chunks
+                ]
+            )
+            blobs = [blob for part in parts for blob in part]
+        offload.record_dumps(node_cls, blobs[-1])
+        return blobs
+
     async def set_all(
         self,
         data: Sequence[Tuple[Node, Any]],
@@ -113,10 +275,31 @@ class BaseStorage:
         serializer: Optional[Serializer],
     ):
         update = {}
-        for node, value in data:
-            update[node.full_key()] = self.deserialize(value, serializer)
+        hooked = bool(_hooks) and len(data) > 0
+        start = time_ns() if hooked else 0
+        offload = self.offload
+        if offload is not None and serializer is not None and len(data) > 0:
+            blobs = await self._deserialize_offload(
+                offload, data[0][0].__class__, [v for _, v in data], serializer
+            )
+            for (node, _), blob in zip(data, blobs):
+                update[self.storage_key(node)] = blob
+        else:
+            for node, value in data:
+                update[self.storage_key(node)] = self.deserialize(value, serializer)
+        if hooked:
+            instrumentation.emit(
+                instrumentation.DUMPS,
+                data[0][0].__class__,
+                len(data),
+                self._scheme,
+                start,
+            )
 
         await self.set_by_keys(update, ttl)
 
+    def stats(self) -> Dict[str, float]:
+        return {}
+
     async def close(self):
         return
@@ -0,0 +1,131 @@
+from time import monotonic
+from typing import Dict, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# numeric state in stats
+_STATES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling storage, if breaker opened or a half open probe
+    started after allow() was checked.
+    """
+
+
+class CircuitBreaker:
+    """
+    Track errors and slow calls of a storage. Breaker opens when failure rate of
+    calls in current window reaches error_rate, then storage is skipped for reads
+    and fills. After open_seconds one probe call is let through(half open), breaker
+    closes if probe succeeds, otherwise opens again.
+
+    :param error_rate: failure rate to open breaker, default 0.5.
+    :param latency: calls slower than this seconds count as failures, None to ignore latency.
+    :param min_calls: min calls in window before breaker can open.
+    :param window: seconds of each counting window, counts are reset after window.
+    :param open_seconds: seconds to wait before probing an open breaker.
+    """
+
+    def __init__(
+        self,
+        error_rate: float = 0.5,
+        latency: Optional[float] = None,
+        min_calls: int = 20,
+        window: float = 10,
+        open_seconds: float = 5,
+    ):
+        self.error_rate = error_rate
+        self.latency = latency
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self._state = CLOSED
+        self._window_start = monotonic()
+        self._calls = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._open_count = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """
+        Whether storage should be called, only one probe call at a time if half open.
+        """
+        state = self.state
+        if state == CLOSED:
+            return True
+        return state == HALF_OPEN and not self._probing
+
+    def start(self) -> bool:
+        """
+        Claim a call before it's made, False if breaker is open or half open probe is
+        in flight. Probe claim is released by record or cancel.
+        """
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def cancel(self):
+        self._probing = False
+
+    def record(self, duration: float, success: bool):
+        """
+        Record result of a call, duration in seconds.
+        """
+        if self.latency is not None and duration > self.latency:
+            success = False
+        if self._state == HALF_OPEN:
+            self._probing = False
+            if success:
+                self._close()
+            else:
+                self._open()
+            return
+        if self._state == OPEN:
+            # call started before breaker opened
+            return
+        now = monotonic()
+        if now - self._window_start >= self.window:
+            self._window_start = now
+            self._calls = 0
+            self._failures = 0
+        self._calls += 1
+        if success:
+            return
+        self._failures += 1
+        if (
+            self._calls >= self.min_calls
+            and self._failures >= self._calls * self.error_rate
+        ):
+            self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = monotonic()
+        self._open_count += 1
+
+    def _close(self):
+        self._state = CLOSED
+        self._window_start = monotonic()
+        self._calls = 0
+        self._failures = 0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "breaker_state": _STATES[self.state],
+            "breaker_open_count": self._open_count,
+        }
@@ -0,0 +1,473 @@
+import asyncio
+import logging
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from datetime import timedelta
+from time import perf_counter
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple, cast
+from urllib.parse import urlparse
+
+from cacheme.interfaces import Node
+from cacheme.models import sentinel
+from cacheme.serializer import Serializer, UnknownDictionaryError
+from cacheme.storages.base import BaseStorage, now_ms
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# record header: crc32 of rest of record, flags, key length, value length and
+# expire epoch milliseconds(0 if never expire), followed by key and value bytes
+HEADER = struct.Struct("<IBHIQ")
+TOMBSTONE = 1
+SUFFIX = ".seg"
+LOCK = "LOCK"
+
+# index entry: segment id, value offset, value length, expire
+Entry = Tuple[int, int, int, int]
+
+
+class Segment:
+    """
+    One log file. Active segment is preallocated and mapped writable, sealed segments
+    are truncated to used size and mapped read only.
+    """
+
+    def __init__(self, path: str, id: int):
+        self.path = path
+        self.id = id
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.mm: Optional[mmap.mmap] = None
+        self.capacity = 0
+        # used bytes, next record is written here
+        self.end = 0
+        # bytes of overwritten/removed records and tombstones
+        self.dead = 0
+        # max expire of records, None if any record never expires
+        self.max_expire: Optional[int] = 0
+
+    def size(self) -> int:
+        return os.fstat(self.file.fileno()).st_size
+
+    def open(self, capacity: Optional[int]):
+        """
+        Truncate file to used size, then map it read only if capacity is None,
+        otherwise preallocate to capacity and map it writable.
+        """
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.file.truncate(self.end)
+        if capacity is not None:
+            self.file.truncate(capacity)
+            self.mm = mmap.mmap(self.file.fileno(), capacity)
+        elif self.end > 0:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.capacity = capacity or self.end
+
+    def seal(self):
+        cast(mmap.mmap, self.mm).flush()
+        self.open(None)
+
+    def close(self, remove: bool = False):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+    def track(self, expire: int):
+        if expire == 0:
+            self.max_expire = None
+        elif self.max_expire is not None and expire > self.max_expire:
+            self.max_expire = expire
+
+    def scan(self) -> Iterator[Tuple[int, bool, str, int, int, int]]:
+        """
+        Iterate records from start, yield (offset, tombstone, key, value offset,
+        value length, expire). Stop at first zeroed or torn record, and set end there.
+        """
+        mm = cast(mmap.mmap, self.mm)
+        offset = 0
+        # segment may be dropped while caller is iterating
+        while not mm.closed and offset + HEADER.size <= self.capacity:
+            crc, flags, key_len, value_len, expire = HEADER.unpack_from(mm, offset)
+            if key_len == 0:
+                break
+            value_offset = offset + HEADER.size + key_len
+            end = value_offset + value_len
+            if end > self.capacity or zlib.crc32(mm[offset + 4 : end]) != crc:
+                break
+            key = mm[offset + HEADER.size : value_offset].decode()
+            yield offset, bool(flags & TOMBSTONE), key, value_offset, value_len, expire
+            offset = end
+        if not mm.closed:
+            self.end = offset
+
+
+class DiskStorage(BaseStorage):
+    """
+    Append-only segmented log on local disk with an in-memory hash index. Reads are
+    served from memory-mapped segments, so it can be used as a local tier. Index is
+    rebuilt from segments on connect, torn records at the tail are dropped. Directory
+    is locked with flock, so only one storage(and process) can open it.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        segment_size: int = 64 * 1024 * 1024,
+        max_size: Optional[int] = None,
+        compact_interval: Optional[float] = 60,
+        compact_ratio: float = 0.5,
+        serializer: Optional[Serializer] = None,
+        fsync: bool = False,
+    ):
+        super().__init__(address=address)
+        self.directory = urlparse(address).path[1:]
+        self.segment_size = segment_size
+        # oldest segments are dropped when total size exceeds max_size
+        self.max_size = max_size
+        # seconds between compactions, None to disable compactor
+        self.compact_interval = compact_interval
+        # sealed segment is compacted when dead bytes reach this ratio of its size
+        self.compact_ratio = compact_ratio
+        # local tier reads pass no serializer, so storage always uses its own
+        self.serializer = serializer
+        self.fsync = fsync
+        self.index: Dict[str, Entry] = {}
+        self.segments: Dict[int, Segment] = {}
+        self.active: Optional[Segment] = None
+        self._compactor: Optional[asyncio.Task] = None
+        self._lock: Optional[Any] = None
+        self._compacted_bytes = 0
+        self._compact_count = 0
+        self._compact_duration = 0.0
+
+    def _path(self, id: int) -> str:
+        return os.path.join(self.directory, f"{id:010d}{SUFFIX}")
+
+    async def connect(self):
+        if self.active is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._acquire_lock()
+        ids = sorted(
+            int(name[: -len(SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SUFFIX)
+        )
+        for id in ids:
+            segment = Segment(self._path(id), id)
+            segment.end = segment.size()
+            if segment.end == 0:
+                segment.close(remove=True)
+                continue
+            segment.open(None)
+            self.segments[id] = segment
+            self._recover(segment)
+        if self.segments:
+            # zero torn tail and preallocate again, last segment is appended to
+            active = self.segments[max(self.segments)]
+            active.open(max(self.segment_size, active.end))
+            self.active = active
+        else:
+            self._new_segment(0)
+        if self.compact_interval is not None and self._compactor is None:
+            self._compactor = asyncio.create_task(self._compact_loop())
+
+    def _acquire_lock(self):
+        # index is in memory, writes of another process would corrupt segments
+        if fcntl is None:
+            return
+        lock = open(os.path.join(self.directory, LOCK), "a+b")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise Exception(f"disk storage directory is in use: {self.directory}")
+        self._lock = lock
+
+    def _recover(self, segment: Segment):
+        for offset, tombstone, key, value_offset, value_len, expire in segment.scan():
+            old = self.index.pop(key, None)
+            if old is not None:
+                self._kill(old, value_offset - offset - HEADER.size)
+            if tombstone:
+                segment.dead += value_offset + value_len - offset
+                continue
+            self.index[key] = (segment.id, value_offset, value_len, expire)
+            segment.track(expire)
+
+    async def close(self):
+        if self._compactor is not None:
+            self._compactor.cancel()
+            self._compactor = None
+        if self.active is not None:
+            self.active.seal()
+        for segment in self.segments.values():
+            segment.close(remove=segment.end == 0)
+        self.segments = {}
+        self.index = {}
+        self.active = None
+        if self._lock is not None:
+            # closing file releases flock
+            self._lock.close()
+            self._lock = None
+
+    def _new_segment(self, size: int):
+        id = max(self.segments) + 1 if self.segments else 0
+        segment = Segment(self._path(id), id)
+        segment.open(max(self.segment_size, size))
+        self.segments[id] = segment
+        self.active = segment
+
+    def _rotate(self, size: int):
+        active = cast(Segment, self.active)
+        active.seal()
+        if active.end == 0:
+            del self.segments[active.id]
+            active.close(remove=True)
+        self._new_segment(size)
+        if self.max_size is None:
+            return
+        while (
+            len(self.segments) > 1
+            and sum(s.end for s in self.segments.values()) > self.max_size
+        ):
+            self._drop(self.segments[min(self.segments)])
+
+    def _drop(self, segment: Segment):
+        for _, tombstone, key, value_offset, _, _ in segment.scan():
+            entry = self.index.get(key)
+            if (
+                not tombstone
+                and entry is not None
+                and entry[0] == segment.id
+                and entry[1] == value_offset
+            ):
+                del self.index[key]
+        del self.segments[segment.id]
+        segment.close(remove=True)
+
+    def _append(self, key: bytes, value: bytes, expire: int, flags: int) -> int:
+        """
+        Append record to active segment, return value offset. Active segment is
+        rotated first if record doesn't fit.
+        """
+        if len(key) > 0xFFFF:
+            raise Exception("key too long")
+        size = HEADER.size + len(key) + len(value)
+        active = cast(Segment, self.active)
+        if active.end + size > active.capacity:
+            self._rotate(size)
+            active = cast(Segment, self.active)
+        mm = cast(mmap.mmap, active.mm)
+        offset = active.end
+        value_offset = offset + HEADER.size + len(key)
+        header = HEADER.pack(0, flags, len(key), len(value), expire)
+        crc = zlib.crc32(value, zlib.crc32(key, zlib.crc32(header[4:])))
+        # header is written last, so a torn record never passes crc check
+        mm[offset + HEADER.size : value_offset] = key
+        mm[value_offset : value_offset + len(value)] = value
+        HEADER.pack_into(mm, offset, crc, flags, len(key), len(value), expire)
+        active.end = value_offset + len(value)
+        if flags & TOMBSTONE:
+            active.dead += size
+        else:
+            active.track(expire)
+        if self.fsync:
+            mm.flush()
+        return value_offset
+
+    def _kill(self, entry: Entry, key_len: int):
+        self.segments[entry[0]].dead += HEADER.size + key_len + entry[2]
+
+    def _put(self, key: str, value: bytes, expire: int):
+        key_bytes = key.encode()
+        value_offset = self._append(key_bytes, value, expire, 0)
+        old = self.index.get(key)
+        if old is not None:
+            self._kill(old, len(key_bytes))
+        self.index[key] = (
+            cast(Segment, self.active).id,
+            value_offset,
+            len(value),
+            expire,
+        )
+
+    def _delete(self, key: str):
+        if key not in self.index:
+            return
+        key_bytes = key.encode()
+        self._append(key_bytes, b"", 0, TOMBSTONE)
+        # segment of old record may be dropped by rotation
+        old = self.index.pop(key, None)
+        if old is not None:
+            self._kill(old, len(key_bytes))
+
+    def _read(self, key: str, now: int) -> Any:
+        entry = self.index.get(key)
+        if entry is None:
+            return sentinel
+        # remove expired record on read, so its bytes are reclaimed by compaction
+        if entry[3] and entry[3] <= now:
+            self._delete(key)
+            return sentinel
+        mm = cast(mmap.mmap, self.segments[entry[0]].mm)
+        start, end = entry[1], entry[1] + entry[2]
+        if self.serializer is not None:
+            try:
+                return self.serializer.loads(mm[start:end])
+            except UnknownDictionaryError:
+                return sentinel
+        # pickle loads from mapped pages directly, view is released so mmap can close
+        view = memoryview(mm)[start:end]
+        try:
+            return pickle.loads(view)
+        finally:
+            view.release()
+
+    def _dumps(self, value: Any) -> bytes:
+        if self.serializer is not None:
+            return self.serializer.dumps(value)
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _expire(self, ttl: Optional[timedelta]) -> int:
+        if ttl is None:
+            return 0
+        return now_ms() + int(ttl.total_seconds() * 1000)
+
+    async def get(self, node: Node, serializer: Optional[Serializer]) -> Any:
+        return self._read(node.full_key(), now_ms())
+
+    def get_sync(self, node: Node, serializer: Optional[Serializer]) -> Any:
+        return self._read(node.full_key(), now_ms())
+
+    async def set(
+        self,
+        node: Node,
+        value: Any,
+        ttl: Optional[timedelta],
+        serializer: Optional[Serializer],
+    ):
+        self._put(node.full_key(), self._dumps(value), self._expire(ttl))
+
+    async def remove(self, node: Node):
+        self._delete(node.full_key())
+
+    async def get_all(
+        self,
+        nodes: Sequence[Node],
+        serializer: Optional[Serializer],
+    ) -> Sequence[Tuple[Node, Any]]:
+        return self.get_all_sync(nodes, serializer)
+
+    def get_all_sync(
+        self,
+        nodes: Sequence[Node],
+        serializer: Optional[Serializer],
+    ) -> Sequence[Tuple[Node, Any]]:
+        if len(nodes) == 0:
+            return []
+        now = now_ms()
+        results = []
+        for node in nodes:
+            v = self._read(node.full_key(), now)
+            if v is not sentinel:
+                results.append((node, v))
+        return results
+
+    async def set_all(
+        self,
+        data: Sequence[Tuple[Node, Any]],
+        ttl: Optional[timedelta],
+        serializer: Optional[Serializer],
+    ):
+        expire = self._expire(ttl)
+        for node, value in data:
+            self._put(node.full_key(), self._dumps(value), expire)
+
+    async def compact(self) -> int:
+        """
+        Rewrite live records of sealed segments with enough dead bytes, or with all
+        records expired, to active segment and remove them. Return removed bytes.
+        """
+        start = perf_counter()
+        now = now_ms()
+        total = 0
+        for id in sorted(self.segments):
+            segment = self.segments.get(id)
+            if segment is None or segment is self.active:
+                continue
+            expired = segment.max_expire is not None and segment.max_expire <= now
+            if expired or segment.dead >= segment.end * self.compact_ratio:
+                total += await self._compact_segment(segment, now)
+        self._compacted_bytes += total
+        self._compact_count += 1
+        self._compact_duration = perf_counter() - start
+        return total
+
+    async def _compact_segment(self, segment: Segment, now: int) -> int:
+        # older segments may have records of same key, a dropped tombstone or expired
+        # record would bring them back on recovery, so keep a tombstone instead
+        oldest = segment.id == min(self.segments)
+        records = segment.scan()
+        for i, (_, tombstone, key, value_offset, value_len, expire) in enumerate(
+            records
+        ):
+            if tombstone:
+                if not oldest and key not in self.index:
+                    self._append(key.encode(), b"", 0, TOMBSTONE)
+            else:
+                entry = self.index.get(key)
+                if (
+                    entry is not None
+                    and entry[0] == segment.id
+                    and entry[1] == value_offset
+                ):
+                    if entry[3] and entry[3] <= now:
+                        del self.index[key]
+                        if not oldest:
+                            self._append(key.encode(), b"", 0, TOMBSTONE)
+                    else:
+                        value = cast(mmap.mmap, segment.mm)[
+                            value_offset : value_offset + value_len
+                        ]
+                        self._put(key, value, expire)
+            # let other tasks run, segment may be dropped meanwhile
+            if i % 1000 == 999:
+                await asyncio.sleep(0)
+            if segment.id not in self.segments:
+                return 0
+        del self.segments[segment.id]
+        segment.close(remove=True)
+        return segment.end
+
+    async def _compact_loop(self):
+        while True:
+            await asyncio.sleep(cast(float, self.compact_interval))
+            try:
+                await self.compact()
+            except Exception:
+                # such as disk full, retry on next interval
+                logger.exception("disk storage compaction failed")
+                continue
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "keys": len(self.index),
+            "segments": len(self.segments),
+            "bytes": sum(s.end for s in self.segments.values()),
+            "dead_bytes": sum(s.dead for s in self.segments.values()),
+            "compact_count": self._compact_count,
+            "compacted_bytes": self._compacted_bytes,
+            "compact_last_seconds": self._compact_duration,
+        }
@@ -1,40 +1,112 @@
+import asyncio
+import logging
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional
+from time import perf_counter
+from typing import Any, Dict, List, Optional, cast
 
 import motor.motor_asyncio as mongo
 from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
 
-from cacheme.storages.base import BaseStorage
+from cacheme.storages.base import BaseStorage, expire_at, now_value
+
+
+logger = logging.getLogger(__name__)
+
+# only fields needed by serialize
+PROJECTION = {"_id": 0, "key": 1, "value": 1, "expire": 1}
 
 
 class MongoStorage(BaseStorage):
     def __init__(
-        self, address: str, database: str, collection: str, pool_size: int = 50
+        self,
+        address: str,
+        database: str,
+        collection: str,
+        pool_size: int = 50,
+        epoch_expire: bool = False,
+        chunk_size: int = 500,
+        reap_interval: Optional[float] = None,
     ):
+        if epoch_expire and reap_interval is None:
+            # TTL index only works on date, nothing else removes expired documents
+            raise Exception("epoch_expire requires reap_interval")
         super().__init__(address=address)
         self.address = address
         self.database = database
         self.collection = collection
         self.pool_size = pool_size
+        # store expire as epoch milliseconds integer instead of date
+        self.epoch_expire = epoch_expire
+        # get_by_keys splits keys to chunks of this size, fetched concurrently
+        self.chunk_size = chunk_size
+        # seconds between expired documents reaping, None to disable reaper
+        self.reap_interval = reap_interval
+        self._reaper: Optional[asyncio.Task] = None
+        self._reaped_rows = 0
+        self._reap_count = 0
+        self._reap_duration = 0.0
 
     async def connect(self):
         client = mongo.AsyncIOMotorClient(self.address, maxPoolSize=self.pool_size)
         self.table = client[self.database][self.collection]
+        if self.reap_interval is not None and self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+    async def ensure_indexes(self):
+        """
+        Create unique index on key, and TTL index on expire so server removes expired documents.
+        TTL index only works on date, so a normal index used by reaper is created if epoch_expire is True.
+        """
+        await self.table.create_index("key", unique=True)
+        if self.epoch_expire:
+            try:
+                await self.table.create_index("expire")
+            except OperationFailure as e:
+                # IndexOptionsConflict, TTL index on expire already exists and still
+                # serves reaper queries
+                if e.code != 85:
+                    raise
+            return
+        try:
+            await self.table.create_index("expire", expireAfterSeconds=0)
+        except OperationFailure as e:
+            # IndexOptionsConflict, normal index on expire already exists
+            if e.code != 85:
+                raise
+            await self.table.database.command(
+                "collMod",
+                self.collection,
+                index={"keyPattern": {"expire": 1}, "expireAfterSeconds": 0},
+            )
+
+    # expired documents are filtered by query, never transferred
+    def _not_expired(self) -> Dict[str, Any]:
+        return {
+            "$or": [
+                {"expire": None},
+                {"expire": {"$gt": now_value(self.epoch_expire)}},
+            ]
+        }
 
     async def get_by_key(self, key: str) -> Any:
-        return await self.table.find_one({"key": key})
+        return await self.table.find_one(
+            {"key": key, **self._not_expired()}, PROJECTION
+        )
 
     async def set_by_key(self, key: str, value: Any, ttl: Optional[timedelta]):
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
         await self.table.update_one(
             {"key": key},
             {
                 "$set": {
                     "value": value,
                     "updated_at": datetime.now(timezone.utc),
-                    "expire": expire,
+                    "expire": expire_at(ttl, self.epoch_expire),
                 }
             },
             True,
@@ -43,21 +115,33 @@ class MongoStorage(BaseStorage):
     async def remove_by_key(self, key: str):
         await self.table.delete_one({"key": key})
 
+    async def _get_chunk(self, keys: List[str]) -> List[Any]:
+        return await self.table.find(
+            {"key": {"$in": keys}, **self._not_expired()}, PROJECTION
+        ).to_list(None)
+
     async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
-        results = await self.table.find({"key": {"$in": keys}}).to_list(None)
-        return {r["key"]: r for r in results}
+        if len(keys) <= self.chunk_size:
+            results = await self._get_chunk(keys)
+            return {r["key"]: r for r in results}
+        chunks = await asyncio.gather(
+            *[
+                self._get_chunk(keys[i : i + self.chunk_size])
+                for i in range(0, len(keys), self.chunk_size)
+            ]
+        )
+        return {r["key"]: r for chunk in chunks for r in chunk}
 
     async def set_by_keys(self, data: Dict[str, Any], ttl: Optional[timedelta]):
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
+        expire = expire_at(ttl, self.epoch_expire)
+        now = datetime.now(timezone.utc)
         requests = [
             UpdateOne(
                 {"key": k},
                 {
                     "$set": {
                         "value": v,
-                        "updated_at": datetime.now(timezone.utc),
+                        "updated_at": now,
                         "expire": expire,
                     }
                 },
@@ -65,4 +149,46 @@ class MongoStorage(BaseStorage):
             )
             for k, v in data.items()
         ]
-        await self.table.bulk_write(requests)
+        # unordered, so server can apply writes in parallel and not stop at first error
+        await self.table.bulk_write(requests, ordered=False)
+
+    async def migrate_expire_to_epoch(self):
+        """
+        Convert expire field from date to epoch milliseconds integer, use epoch_expire=True after migration.
+        TTL index skips converted documents, they are removed by reaper of epoch_expire storage.
+        """
+        await self.table.update_many(
+            {"expire": {"$type": "date"}},
+            [{"$set": {"expire": {"$toLong": "$expire"}}}],
+        )
+
+    async def reap(self) -> int:
+        """
+        Delete all expired documents.
+        """
+        start = perf_counter()
+        result = await self.table.delete_many(
+            {"expire": {"$lte": now_value(self.epoch_expire)}}
+        )
+        self._reaped_rows += result.deleted_count
+        self._reap_count += 1
+        self._reap_duration = perf_counter() - start
+        return result.deleted_count
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(cast(float, self.reap_interval))
+            try:
+                await self.reap()
+            except Exception:
+                # storage may be unavailable temporarily, retry on next interval
+                logger.exception("mongo storage reap failed")
+
+    def stats(self) -> Dict[str, float]:
+        if self.reap_interval is None and self._reap_count == 0:
+            return {}
+        return {
+            "reaped_rows": self._reaped_rows,
+            "reap_count": self._reap_count,
+            "reap_last_seconds": self._reap_duration,
+        }
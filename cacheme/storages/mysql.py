@@ -1,17 +1,43 @@
-from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional
+import asyncio
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, cast
 from urllib.parse import urlparse
 
 import aiomysql
 
+from cacheme.interfaces import CachedData
+from cacheme.serializer import Serializer
+from cacheme.storages.base import epoch_ms, expire_at, now_value
 from cacheme.storages.sqldb import SQLStorage
 
 
 class MySQLStorage(SQLStorage):
-    def __init__(self, address: str, table: str, pool_size: int = 50):
-        super().__init__(address, table=table)
+    def __init__(
+        self,
+        address: str,
+        table: str,
+        pool_size: int = 50,
+        reap_interval: Optional[float] = None,
+        reap_batch_size: int = 1000,
+        epoch_expire: bool = False,
+        chunk_size: int = 500,
+    ):
+        super().__init__(
+            address,
+            table=table,
+            reap_interval=reap_interval,
+            reap_batch_size=reap_batch_size,
+            epoch_expire=epoch_expire,
+        )
         self.pool_size = pool_size
         self.table = table
+        # get_by_keys splits keys to chunks of this size, fetched concurrently
+        self.chunk_size = chunk_size
+        # updated from server on connect, multi-row inserts are sized to fit in it
+        self.max_allowed_packet = 4 * 1024 * 1024
+        self.get_sql = f"select value, expire from {table} where `key`=%s and (expire is null or expire > %s)"
+        self.get_many_sql: Dict[int, str] = {}
+        self.upsert_sql: Dict[int, str] = {}
 
     async def _connect(self):
         url = urlparse(self.address)
@@ -25,67 +51,115 @@ class MySQLStorage(SQLStorage):
             autocommit=True,
             maxsize=self.pool_size,
         )
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("select @@max_allowed_packet")
+                (self.max_allowed_packet,) = await cur.fetchone()
 
-    async def close(self):
+    async def _close(self):
         self.pool.close()
         await self.pool.wait_closed()
 
+    def stats(self) -> Dict[str, float]:
+        return {
+            "connections_in_use": self.pool.size - self.pool.freesize,
+            "connections": self.pool.size,
+            "connections_max": self.pool.maxsize,
+            **self.reaper_stats(),
+        }
+
     async def execute_ddl(self, ddl):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(ddl)
 
-    async def get_by_key(self, key: str) -> Any:
+    # mysql doesn't support create index if not exists
+    async def ensure_expire_index(self):
         async with self.pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
+            async with conn.cursor() as cur:
                 await cur.execute(
-                    f"select * from {self.table} where `key`=%s",
-                    (key,),
+                    "select 1 from information_schema.statistics where table_schema=database() and table_name=%s and column_name='expire'",
+                    (self.table,),
                 )
+                if await cur.fetchone() is None:
+                    await cur.execute(
+                        f"create index ix_{self.table}_expire on {self.table} (expire)"
+                    )
+
+    # raw is (value, expire) row
+    def serialize(self, raw: Any, serializer: Optional[Serializer]) -> CachedData:
+        data, expire = raw
+        if serializer is not None:
+            data = serializer.loads(cast(bytes, data))
+        if expire is not None and not isinstance(expire, int):
+            expire = epoch_ms(expire)
+        return CachedData(data=data, expire=expire)
+
+    async def get_by_key(self, key: str) -> Any:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self.get_sql, (key, now_value(self.epoch_expire)))
                 return await cur.fetchone()
 
     async def set_by_key(self, key: str, value: Any, ttl: Optional[timedelta]):
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
+        expire = expire_at(ttl, self.epoch_expire)
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    f"insert into {self.table}(`key`, value, expire) values(%s,%s,%s) ON DUPLICATE KEY UPDATE value=VALUES(value), expire=VALUES(expire)",
-                    (
-                        key,
-                        value,
-                        expire,
-                    ),
-                )
+                await cur.execute(self._upsert_sql(1), (key, value, expire))
 
-    async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
+    def _upsert_sql(self, rows: int) -> str:
+        sql = self.upsert_sql.get(rows)
+        if sql is None:
+            values = ", ".join(["(%s,%s,%s)"] * rows)
+            sql = f"insert into {self.table}(`key`, value, expire) values {values} ON DUPLICATE KEY UPDATE value=VALUES(value), expire=VALUES(expire)"
+            self.upsert_sql[rows] = sql
+        return sql
+
+    async def _get_chunk(self, keys: List[str], now: Any) -> Dict[str, Any]:
+        sql = self.get_many_sql.get(len(keys))
+        if sql is None:
+            sql = f"select `key`, value, expire from {self.table} where `key` in ({', '.join(['%s'] * len(keys))}) and (expire is null or expire > %s)"
+            self.get_many_sql[len(keys)] = sql
         async with self.pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                sql = "SELECT * FROM {} WHERE `key` in ({})".format(
-                    self.table, ", ".join("%s" for _ in keys)
-                )
-                await cur.execute(sql, keys)
-                result = await cur.fetchall()
-        return {i["key"]: i for i in result}
+            async with conn.cursor() as cur:
+                await cur.execute(sql, (*keys, now))
+                rows = await cur.fetchall()
+        return {key: (value, expire) for key, value, expire in rows}
+
+    async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
+        now = now_value(self.epoch_expire)
+        if len(keys) <= self.chunk_size:
+            return await self._get_chunk(keys, now)
+        results: Dict[str, Any] = {}
+        for chunk in await asyncio.gather(
+            *[
+                self._get_chunk(keys[i : i + self.chunk_size], now)
+                for i in range(0, len(keys), self.chunk_size)
+            ]
+        ):
+            results.update(chunk)
+        return results
 
     async def set_by_keys(self, data: Dict[str, Any], ttl: Optional[timedelta]):
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
+        expire = expire_at(ttl, self.epoch_expire)
+        # escaped binary may double in size, keep some room for statement itself
+        budget = self.max_allowed_packet // 2 - 4096
+        chunks: List[List[Any]] = [[]]
+        size = 0
+        for key, value in data.items():
+            row_size = len(key) + len(value) + 64
+            if chunks[-1] and size + row_size > budget:
+                chunks.append([])
+                size = 0
+            chunks[-1].extend((key, value, expire))
+            size += row_size
+        # chunks are written in order on one connection, concurrent upserts
+        # of overlapping index ranges may deadlock
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.executemany(
-                    f"insert into {self.table}(`key`, value, expire) values(%s,%s,%s) ON DUPLICATE KEY UPDATE value=VALUES(value), expire=VALUES(expire)",
-                    [
-                        (
-                            key,
-                            value,
-                            expire,
-                        )
-                        for key, value in data.items()
-                    ],
-                )
+                for chunk in chunks:
+                    if chunk:
+                        await cur.execute(self._upsert_sql(len(chunk) // 3), chunk)
 
     async def remove_by_key(self, key: str):
         async with self.pool.acquire() as conn:
@@ -94,3 +168,37 @@ class MySQLStorage(SQLStorage):
                     f"delete from {self.table} where `key`=%s",
                     (key,),
                 )
+
+    # mysql can't convert datetime to bigint in place, so copy to a new column.
+    # datetimes are written as UTC wall time, read them in UTC session.
+    async def migrate_expire_to_epoch(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("select @@session.time_zone")
+                (time_zone,) = await cur.fetchone()
+                await cur.execute("set time_zone = '+00:00'")
+                # connection goes back to pool, restore time zone even on failure
+                try:
+                    await cur.execute(
+                        f"alter table {self.table} add column expire_ms bigint"
+                    )
+                    await cur.execute(
+                        f"update {self.table} set expire_ms = round(unix_timestamp(expire) * 1000)"
+                    )
+                    await cur.execute(
+                        f"alter table {self.table} drop column expire, rename column expire_ms to expire"
+                    )
+                    await cur.execute(
+                        f"create index ix_{self.table}_expire on {self.table} (expire)"
+                    )
+                finally:
+                    await cur.execute("set time_zone = %s", (time_zone,))
+
+    async def remove_expired(self, limit: int) -> int:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"delete from {self.table} where expire < %s limit %s",
+                    (now_value(self.epoch_expire), limit),
+                )
+                return cur.rowcount
@@ -0,0 +1,138 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Type, TypeVar
+
+from cacheme.interfaces import Node
+from cacheme.serializer import Serializer
+
+T = TypeVar("T")
+
+
+def payload_size(raw: Any) -> int:
+    """
+    Size of a stored value: raw bytes, (value, expire) row or row/document with value field.
+    """
+    if isinstance(raw, tuple):
+        raw = raw[0]
+    elif not isinstance(raw, (bytes, bytearray, memoryview, str)):
+        try:
+            raw = raw["value"]
+        except (KeyError, TypeError):
+            return 0
+    if isinstance(raw, (bytes, bytearray, memoryview, str)):
+        return len(raw)
+    return 0
+
+
+class ProcessSerializer:
+    """
+    Run serializer in process pool, blocks calling thread until done.
+    """
+
+    def __init__(self, serializer: Serializer, executor: Executor):
+        self.serializer = serializer
+        self.executor = executor
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.executor.submit(self.serializer.dumps, obj).result()
+
+    def loads(self, blob: bytes) -> Any:
+        return self.executor.submit(self.serializer.loads, bytes(blob)).result()
+
+
+class OffloadPolicy:
+    """
+    Run (de)serialization of large payloads in thread pool, instead of blocking event
+    loop. Payloads smaller than threshold stay inline. Size of loads is known from
+    stored value, dumps is offloaded if last dumps of same node class was large.
+    get_all/set_all values are split into chunks of about chunk_size bytes,
+    (de)serialized in pool concurrently.
+
+    :param threshold: payload bytes to offload, default 256KB.
+    :param chunk_size: bytes of each get_all/set_all chunk, default threshold.
+    :param executor: thread pool, default a 4 workers ThreadPoolExecutor created on first use.
+    :param process_executor: run serializer in this process pool from thread pool, to
+        avoid holding GIL. Serializer and values must be picklable.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 256 * 1024,
+        chunk_size: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        process_executor: Optional[Executor] = None,
+    ):
+        self.threshold = threshold
+        self.chunk_size = chunk_size if chunk_size is not None else threshold
+        self._executor = executor
+        self.process_executor = process_executor
+        # node class -> last dumps size
+        self._dumps_sizes: Dict[Type[Node], int] = {}
+        self._count = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="cacheme-offload"
+            )
+        return self._executor
+
+    def _serializer(self, serializer: Serializer) -> Serializer:
+        if self.process_executor is None:
+            return serializer
+        return ProcessSerializer(serializer, self.process_executor)
+
+    def offload_loads(self, raw: Any) -> bool:
+        return payload_size(raw) >= self.threshold
+
+    def offload_dumps(self, node: Type[Node]) -> bool:
+        return self._dumps_sizes.get(node, 0) >= self.threshold
+
+    def record_dumps(self, node: Type[Node], blob: Any):
+        self._dumps_sizes[node] = payload_size(blob)
+
+    def dumps_chunks(
+        self, node: Type[Node], values: Sequence[Any]
+    ) -> Optional[List[Sequence[Any]]]:
+        """
+        Split values to dumps in pool, using last dumps size of node class as size of
+        each value. None if total size is small enough to dump inline.
+        """
+        size = self._dumps_sizes.get(node, 0)
+        if size == 0 or size * len(values) < self.threshold:
+            return None
+        step = max(1, self.chunk_size // size)
+        return [values[i : i + step] for i in range(0, len(values), step)]
+
+    def chunks(self, raws: Sequence[Any]) -> Optional[List[List[Any]]]:
+        """
+        Split raws to consecutive chunks, None if total size is small enough to decode inline.
+        """
+        chunks: List[List[Any]] = [[]]
+        size = total = 0
+        for raw in raws:
+            n = payload_size(raw)
+            if size > 0 and size + n > self.chunk_size:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(raw)
+            size += n
+            total += n
+        if total < self.threshold:
+            return None
+        return chunks
+
+    async def run(
+        self, fn: Callable[[Any, Serializer], T], value: Any, serializer: Serializer
+    ) -> T:
+        """
+        Run storage serialize/deserialize with value in pool.
+        """
+        self._count += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, value, self._serializer(serializer)
+        )
+
+    def stats(self) -> Dict[str, float]:
+        return {"offloaded": self._count}
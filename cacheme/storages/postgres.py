@@ -1,24 +1,92 @@
-from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, cast
+from datetime import timedelta
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence
 
 from asyncpg.connection import asyncpg
 from asyncpg.pool import Pool
 
+from cacheme.storages.base import expire_at, now_value
+from cacheme.storages.replica import LEAST_OUTSTANDING, ReplicaRouter
 from cacheme.storages.sqldb import SQLStorage
 
 
 class PostgresStorage(SQLStorage):
-    def __init__(self, address: str, table: str, pool_size: int = 50):
-        super().__init__(address, table=table)
+    def __init__(
+        self,
+        address: str,
+        table: str,
+        pool_size: int = 50,
+        reap_interval: Optional[float] = None,
+        reap_batch_size: int = 1000,
+        epoch_expire: bool = False,
+        copy_threshold: int = 20000,
+        replicas: Sequence[str] = (),
+        replica_balance: str = LEAST_OUTSTANDING,
+        read_your_writes: Optional[float] = None,
+    ):
+        super().__init__(
+            address,
+            table=table,
+            reap_interval=reap_interval,
+            reap_batch_size=reap_batch_size,
+            epoch_expire=epoch_expire,
+        )
         self.pool_size = pool_size
         self.pool = None
         self.table = table
+        # reads go to replicas, writes and removes go to primary address
+        self.replicas = list(replicas)
+        self.router: Optional[ReplicaRouter] = None
+        if self.replicas:
+            self.router = ReplicaRouter(
+                len(self.replicas), replica_balance, read_your_writes
+            )
+        # pools of primary and replicas, indexed by router
+        self.pools: List[Pool] = []
+        # set_by_keys with more rows than this use COPY instead of unnest
+        self.copy_threshold = copy_threshold
+        expire_type = "bigint" if epoch_expire else "timestamptz"
+        self.expire_type = expire_type
+        # asyncpg prepares and caches statements per connection by sql text,
+        # so build sql once and reuse same text
+        upsert = "on conflict(key) do update set value=EXCLUDED.value, expire=EXCLUDED.expire"
+        self.get_sql = (
+            f"select * from {table} where key=$1 and (expire is null or expire > $2)"
+        )
+        self.get_many_sql = f"select * from {table} where key=any($1::text[]) and (expire is null or expire > $2)"
+        self.upsert_sql = (
+            f"insert into {table}(key, value, expire) values($1,$2,$3) {upsert}"
+        )
+        self.bulk_upsert_sql = f"insert into {table}(key, value, expire) select k, v, $3::{expire_type} from unnest($1::text[], $2::bytea[]) as t(k, v) {upsert}"
+        self.copy_table = f"{table}_copy"
+        self.copy_ddl = f"create temp table if not exists {self.copy_table} (key text, value bytea) on commit delete rows"
+        self.copy_upsert_sql = f"insert into {table}(key, value, expire) select key, value, $1::{expire_type} from {self.copy_table} {upsert}"
+        self.delete_sql = f"delete from {table} where key=$1"
+        self.remove_expired_sql = f"delete from {table} where id in (select id from {table} where expire < $1 limit $2)"
 
     async def _connect(self):
-        self.pool = await asyncpg.create_pool(dsn=self.address, max_size=self.pool_size)
+        self.pools = await asyncio.gather(
+            *[
+                asyncpg.create_pool(dsn=address, max_size=self.pool_size)
+                for address in [self.address, *self.replicas]
+            ]
+        )
+        self.pool = self.pools[0]
+
+    async def _close(self):
+        await asyncio.gather(*[pool.close() for pool in self.pools])
 
-    async def close(self):
-        await cast(Pool, self.pool).close()
+    def stats(self) -> Dict[str, float]:
+        if self.pool is None:
+            return {}
+        size = self.pool.get_size()
+        return {
+            "connections_in_use": size - self.pool.get_idle_size(),
+            "connections": size,
+            "connections_max": self.pool.get_max_size(),
+            **self.reaper_stats(),
+            **(self.router.stats() if self.router is not None else {}),
+        }
 
     async def execute_ddl(self, ddl):
         if self.pool is None:
@@ -26,56 +94,92 @@ class PostgresStorage(SQLStorage):
         async with self.pool.acquire() as conn:
             await conn.execute(ddl)
 
+    async def create_table(self, unlogged: bool = False):
+        """
+        Create cache table and expire index if not exist.
+
+        :param unlogged: create UNLOGGED table, writes skip WAL so much faster, but table is truncated after crash and not replicated.
+        """
+        await self.execute_ddl(
+            f"create {'unlogged ' if unlogged else ''}table if not exists {self.table} (id serial primary key, key varchar(512) unique, value bytea, expire {self.expire_type}, updated_at timestamptz default now())"
+        )
+        await self.ensure_expire_index()
+
     async def get_by_key(self, key: str) -> Any:
         if self.pool is None:
             raise
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow(f"select * from {self.table} where key=$1", key)
+        if self.router is None:
+            return await self._get_by_key(0, key)
+        return await self.router.read((key,), lambda i: self._get_by_key(i, key))
+
+    async def _get_by_key(self, index: int, key: str) -> Any:
+        async with self.pools[index].acquire() as conn:
+            return await conn.fetchrow(self.get_sql, key, now_value(self.epoch_expire))
 
     async def set_by_key(self, key: str, value: Any, ttl: Optional[timedelta]):
         if self.pool is None:
             raise
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
+        expire = expire_at(ttl, self.epoch_expire)
         async with self.pool.acquire() as conn:
-            await conn.execute(
-                f"insert into {self.table}(key, value, expire) values($1,$2,$3) on conflict(key) do update set value=EXCLUDED.value, expire=EXCLUDED.expire",
-                key,
-                value,
-                expire,
-            )
+            await conn.execute(self.upsert_sql, key, value, expire)
+        if self.router is not None:
+            self.router.written((key,))
 
     async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
         if self.pool is None:
             raise
-        async with self.pool.acquire() as conn:
+        if self.router is None:
+            return await self._get_by_keys(0, keys)
+        return await self.router.read(keys, lambda i: self._get_by_keys(i, keys))
+
+    async def _get_by_keys(self, index: int, keys: List[str]) -> Dict[str, Any]:
+        async with self.pools[index].acquire() as conn:
             records = await conn.fetch(
-                f"select * from {self.table} where key=any($1::text[])", keys
+                self.get_many_sql, keys, now_value(self.epoch_expire)
             )
         return {r["key"]: r for r in records}
 
     async def set_by_keys(self, data: Dict[str, Any], ttl: Optional[timedelta]):
         if self.pool is None:
             raise
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
+        expire = expire_at(ttl, self.epoch_expire)
         async with self.pool.acquire() as conn:
-            await conn.executemany(
-                f"insert into {self.table}(key, value, expire) values($1,$2,$3) on conflict(key) do update set value=EXCLUDED.value, expire=EXCLUDED.expire",
-                [
-                    (
-                        key,
-                        value,
-                        expire,
+            if len(data) > self.copy_threshold:
+                # copy to session temp table, then upsert with one statement
+                async with conn.transaction():
+                    await conn.execute(self.copy_ddl)
+                    await conn.copy_records_to_table(
+                        self.copy_table, records=data.items(), columns=["key", "value"]
                     )
-                    for key, value in data.items()
-                ],
-            )
+                    await conn.execute(self.copy_upsert_sql, expire)
+            else:
+                # one statement for whole batch, instead of one per row
+                await conn.execute(
+                    self.bulk_upsert_sql, list(data.keys()), list(data.values()), expire
+                )
+        if self.router is not None:
+            self.router.written(data.keys())
 
     async def remove_by_key(self, key: str):
         if self.pool is None:
             raise
         async with self.pool.acquire() as conn:
-            return await conn.execute(f"delete from {self.table} where key=$1", key)
+            status = await conn.execute(self.delete_sql, key)
+        if self.router is not None:
+            self.router.written((key,))
+        return status
+
+    async def migrate_expire_to_epoch(self):
+        await self.execute_ddl(
+            f"alter table {self.table} alter column expire type bigint using (extract(epoch from expire) * 1000)::bigint"
+        )
+
+    async def remove_expired(self, limit: int) -> int:
+        if self.pool is None:
+            raise
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                self.remove_expired_sql, now_value(self.epoch_expire), limit
+            )
+        # status is "DELETE <count>"
+        return int(status.split()[-1])
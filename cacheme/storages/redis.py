@@ -1,24 +1,208 @@
+import asyncio
+import struct
+import zlib
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Union, cast
+from time import time_ns
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union, cast
 
 import redis.asyncio as redis
 import redis.asyncio.cluster as redis_cluster
 from redis.asyncio.connection import BlockingConnectionPool
 
-from cacheme.interfaces import CachedData
+from cacheme.interfaces import CachedData, Node
+from cacheme.models import get_prefix
 from cacheme.serializer import Serializer
 from cacheme.storages.base import BaseStorage
+from cacheme.storages.replica import LEAST_OUTSTANDING, ReplicaRouter
+
+# Values are stored as: magic(1 byte), version(1 byte), flags(1 byte),
+# expire in epoch milliseconds(8 bytes, only if FLAG_EXPIRE set), serializer payload.
+# Magic 0xc1 is never used by msgpack and can't be first byte of json/base64/zlib
+# output, so values written with legacy dict envelope are still readable.
+ENVELOPE_MAGIC = 0xC1
+ENVELOPE_VERSION = 1
+FLAG_EXPIRE = 0x01
+_header = struct.Struct(">BBB")
+_header_expire = struct.Struct(">BBBQ")
+_no_expire_header = _header.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, 0)
+
+
+def pack_envelope(payload: bytes, expire: Optional[int]) -> bytes:
+    if expire is None:
+        return _no_expire_header + payload
+    return (
+        _header_expire.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, FLAG_EXPIRE, expire)
+        + payload
+    )
+
+
+def unpack_envelope(blob: bytes) -> Optional[Tuple[memoryview, Optional[int]]]:
+    """
+    Split blob to (payload, expire in epoch milliseconds), None if blob is legacy dict envelope.
+    Payload is a view of blob, so large values are not copied.
+    """
+    if blob[0] != ENVELOPE_MAGIC:
+        return None
+    if blob[1] != ENVELOPE_VERSION:
+        raise Exception(f"unsupported envelope version: {blob[1]}")
+    if blob[2] & FLAG_EXPIRE:
+        return (
+            memoryview(blob)[_header_expire.size :],
+            _header_expire.unpack_from(blob)[3],
+        )
+    return memoryview(blob)[_header.size :], None
+
+
+def envelope_expire(blob: bytes) -> Optional[int]:
+    """
+    Expire in epoch milliseconds from envelope header, without decoding payload.
+    """
+    if blob[0] == ENVELOPE_MAGIC and blob[2] & FLAG_EXPIRE:
+        return _header_expire.unpack_from(blob)[3]
+    return None
+
+
+class AutoPipeline:
+    """
+    Queue commands issued in same event loop iteration and send them in one pipeline,
+    GET commands are coalesced into one MGET. At most max_inflight pipelines are sent
+    concurrently, commands issued meanwhile are queued for next pipeline.
+    """
+
+    def __init__(self, client: redis.Redis, max_inflight: int):
+        self.client = client
+        self.max_inflight = max_inflight
+        self._inflight = 0
+        self._scheduled = False
+        self._gets: Dict[str, List[asyncio.Future]] = {}
+        self._writes: List[Tuple[str, tuple, dict, asyncio.Future]] = []
+
+    def get(self, key: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._gets.setdefault(key, []).append(future)
+        self._schedule()
+        return future
+
+    def execute(self, command: str, *args, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((command, args, kwargs, future))
+        self._schedule()
+        return future
+
+    def _schedule(self):
+        if self._scheduled or self._inflight >= self.max_inflight:
+            return
+        self._scheduled = True
+        asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        if not self._gets and not self._writes:
+            return
+        gets, self._gets = self._gets, {}
+        writes, self._writes = self._writes, []
+        self._inflight += 1
+        asyncio.get_running_loop().create_task(self._send(gets, writes))
+
+    async def _send(
+        self,
+        gets: Dict[str, List[asyncio.Future]],
+        writes: List[Tuple[str, tuple, dict, asyncio.Future]],
+    ):
+        keys = list(gets.keys())
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for command, args, kwargs, _ in writes:
+                    getattr(pipe, command)(*args, **kwargs)
+                if keys:
+                    pipe.mget(keys)
+                responses = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            for futures in gets.values():
+                for future in futures:
+                    _set_exception(future, e)
+            for *_, future in writes:
+                _set_exception(future, e)
+            return
+        finally:
+            self._inflight -= 1
+            if self._gets or self._writes:
+                self._schedule()
+        for (*_, future), response in zip(writes, responses):
+            if isinstance(response, Exception):
+                _set_exception(future, response)
+            elif not future.done():
+                future.set_result(response)
+        if keys:
+            values = responses[-1]
+            if isinstance(values, Exception):
+                for futures in gets.values():
+                    for future in futures:
+                        _set_exception(future, values)
+                return
+            for key, value in zip(keys, values):
+                for future in gets[key]:
+                    if not future.done():
+                        future.set_result(value)
+
+
+def _set_exception(future: asyncio.Future, e: BaseException):
+    if not future.done():
+        future.set_exception(e)
 
 
 class RedisStorage(BaseStorage):
     client: Union[redis.Redis, redis_cluster.RedisCluster]
+    pipeline: Optional[AutoPipeline] = None
+    # (client, auto pipeline) of primary and replicas, indexed by router
+    readers: List[Tuple[Any, Optional[AutoPipeline]]]
 
     def __init__(
-        self, address: str, pool_size: int = 100, cluster: bool = False, **options
+        self,
+        address: str,
+        pool_size: int = 100,
+        cluster: bool = False,
+        legacy_envelope: bool = False,
+        auto_pipeline: bool = False,
+        auto_pipeline_connections: int = 4,
+        hash_buckets: int = 0,
+        hash_field_expire: bool = False,
+        hash_sweep_writes: int = 100,
+        replicas: Sequence[str] = (),
+        replica_balance: str = LEAST_OUTSTANDING,
+        read_your_writes: Optional[float] = None,
+        **options,
     ):
         super().__init__(address=address)
+        if cluster and auto_pipeline:
+            raise Exception("auto_pipeline is not supported in cluster mode")
+        if cluster and replicas:
+            raise Exception(
+                "replicas is not supported in cluster mode, use read_from_replicas"
+            )
+        if hash_buckets and legacy_envelope:
+            raise Exception("hash_buckets requires binary envelope for expire")
         self.pool_size = pool_size
         self.cluster = cluster
+        self.auto_pipeline = auto_pipeline
+        self.auto_pipeline_connections = auto_pipeline_connections
+        # keep writing legacy dict envelope, until all readers are upgraded
+        self.legacy_envelope = legacy_envelope
+        # store entries as fields of hash buckets(per node class) instead of strings
+        self.hash_buckets = hash_buckets
+        # expire fields with HPEXPIRE(redis 7.4+), otherwise expire whole bucket
+        self.hash_field_expire = hash_field_expire
+        # without field expire, sweep expired fields of written buckets every n writes
+        self.hash_sweep_writes = hash_sweep_writes
+        self._hash_writes = 0
+        self._hash_reclaimed = 0
+        # reads go to replicas, writes and removes go to primary address
+        self.replicas = list(replicas)
+        self.router: Optional[ReplicaRouter] = None
+        if self.replicas:
+            self.router = ReplicaRouter(
+                len(self.replicas), replica_balance, read_your_writes
+            )
         self.options = options
 
     async def connect(self):
@@ -28,47 +212,299 @@ class RedisStorage(BaseStorage):
                 max_connections=10 * self.pool_size,
                 **self.options,
             )
+            self.readers = [(self.client, None)]
         else:
-            self.client = await redis.from_url(self.address, **self.options)
-            cast(
-                redis.Redis, self.client
-            ).connection_pool = BlockingConnectionPool.from_url(
-                self.address, max_connections=self.pool_size, timeout=None
-            )
+            self.readers = [
+                await self._connect(address)
+                for address in [self.address, *self.replicas]
+            ]
+            self.client, self.pipeline = self.readers[0]
+
+    async def _connect(
+        self, address: str
+    ) -> Tuple[redis.Redis, Optional[AutoPipeline]]:
+        client = await redis.from_url(address, **self.options)
+        client.connection_pool = BlockingConnectionPool.from_url(
+            address, max_connections=self.pool_size, timeout=None
+        )
+        pipeline = None
+        if self.auto_pipeline:
+            pipeline = AutoPipeline(client, self.auto_pipeline_connections)
+        return client, pipeline
+
+    def stats(self) -> Dict[str, float]:
+        if self.cluster:
+            return {}
+        pool = cast(BlockingConnectionPool, self.client.connection_pool)
+        stats = {
+            "connections_in_use": pool.max_connections - pool.pool.qsize(),
+            "connections_max": pool.max_connections,
+        }
+        if self.hash_buckets:
+            stats["hash_reclaimed"] = self._hash_reclaimed
+        if self.router is not None:
+            stats.update(self.router.stats())
+        return stats
+
+    def storage_key(self, node: Node) -> Any:
+        if not self.hash_buckets:
+            return node.full_key()
+        field = node.key()
+        bucket = zlib.crc32(field.encode()) % self.hash_buckets
+        name = f"{get_prefix()}:{node.__class__.__qualname__}:{node.get_version()}"
+        return f"{name}:{bucket}", field
+
+    def _pipeline(self, client: Any) -> Any:
+        if self.cluster:
+            return client.pipeline()
+        return client.pipeline(transaction=False)
 
     async def get_by_key(self, key: str) -> Any:
-        return await self.client.get(key)  # type: ignore
+        if self.router is None:
+            return await self._get_by_key(0, key)
+        return await self.router.read((key,), lambda i: self._get_by_key(i, key))
+
+    async def _get_by_key(self, index: int, key: Any) -> Any:
+        client, pipeline = self.readers[index]
+        if self.hash_buckets:
+            bucket, field = key
+            if pipeline is not None:
+                value = await pipeline.execute("hget", bucket, field)
+            else:
+                value = await client.hget(bucket, field)
+            if value is not None and await self._hash_reclaim({key: value}):
+                return None
+            return value
+        if pipeline is not None:
+            return await pipeline.get(key)
+        return await client.get(key)
 
     async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
-        values = await self.client.mget(keys)  # type: ignore
+        if self.router is None:
+            return await self._get_by_keys(0, keys)
+        return await self.router.read(keys, lambda i: self._get_by_keys(i, keys))
+
+    async def _get_by_keys(self, index: int, keys: List[Any]) -> Dict[str, Any]:
+        client = self.readers[index][0]
+        if self.hash_buckets:
+            return await self._hash_get_by_keys(client, keys)
+        if self.cluster:
+            return await self._cluster_get_by_keys(keys)
+        values = await client.mget(keys)
         return {keys[i]: v for i, v in enumerate(values) if v is not None}
 
+    # MGET keys must be in same slot, so send one MGET per slot. Cluster pipeline
+    # groups commands by node and sends each node's pipeline concurrently.
+    async def _cluster_get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
+        client = cast(redis_cluster.RedisCluster, self.client)
+        slots: Dict[int, List[str]] = {}
+        for key in keys:
+            slots.setdefault(client.keyslot(key), []).append(key)
+        if len(slots) == 1:
+            groups = [keys]
+            responses = [await client.mget(keys)]
+        else:
+            groups = list(slots.values())
+            async with client.pipeline() as pipe:
+                for group in groups:
+                    # pipe.mget is blocked in cluster mode, send raw command instead
+                    pipe.execute_command("MGET", *group)
+                responses = await pipe.execute()
+        results = {}
+        for group, values in zip(groups, responses):
+            for key, value in zip(group, values):
+                if value is not None:
+                    results[key] = value
+        return results
+
+    async def _hash_get_by_keys(
+        self, client: Any, keys: List[Tuple[str, str]]
+    ) -> Dict[Any, Any]:
+        buckets: Dict[str, List[str]] = {}
+        for bucket, field in keys:
+            buckets.setdefault(bucket, []).append(field)
+        if len(buckets) == 1:
+            bucket, fields = next(iter(buckets.items()))
+            responses = [await client.hmget(bucket, fields)]
+        else:
+            async with self._pipeline(client) as pipe:
+                for bucket, fields in buckets.items():
+                    pipe.hmget(bucket, fields)
+                responses = await pipe.execute()
+        results = {}
+        for (bucket, fields), values in zip(buckets.items(), responses):
+            for field, value in zip(fields, values):
+                if value is not None:
+                    results[(bucket, field)] = value
+        for key in await self._hash_reclaim(results):
+            del results[key]
+        return results
+
+    async def _hash_reclaim(
+        self, values: Dict[Tuple[str, str], bytes]
+    ) -> List[Tuple[str, str]]:
+        """
+        Delete expired fields of whole bucket expire mode, return deleted keys.
+        """
+        if self.hash_field_expire:
+            return []
+        now = time_ns() // 1_000_000
+        expired = []
+        for key, value in values.items():
+            expire = envelope_expire(value)
+            if expire is not None and expire <= now:
+                expired.append(key)
+        if len(expired) == 0:
+            return expired
+        buckets: Dict[str, List[str]] = {}
+        for bucket, field in expired:
+            buckets.setdefault(bucket, []).append(field)
+        # always delete on primary, reads may come from replicas
+        if self.pipeline is not None:
+            await asyncio.gather(
+                *[
+                    self.pipeline.execute("hdel", bucket, *fields)
+                    for bucket, fields in buckets.items()
+                ]
+            )
+        else:
+            async with self._pipeline(self.client) as pipe:
+                for bucket, fields in buckets.items():
+                    pipe.hdel(bucket, *fields)
+                await pipe.execute()
+        self._hash_reclaimed += len(expired)
+        return expired
+
+    async def _hash_sweep(self, buckets: List[str]):
+        async with self._pipeline(self.client) as pipe:
+            for bucket in buckets:
+                pipe.hgetall(bucket)
+            responses = await pipe.execute()
+        values = {}
+        for bucket, mapping in zip(buckets, responses):
+            for field, value in mapping.items():
+                values[(bucket, field)] = value
+        await self._hash_reclaim(values)
+
     def serialize(self, raw: Any, serializer: Optional[Serializer]) -> CachedData:
         if serializer is None:
             raise Exception("serializer is None")
-        data = serializer.loads(cast(bytes, raw))
-        return CachedData(data=data["value"], expire=None)
+        unpacked = unpack_envelope(cast(bytes, raw))
+        if unpacked is None:
+            data = serializer.loads(cast(bytes, raw))
+            return CachedData(data=data["value"], expire=None)
+        payload, expire = unpacked
+        # loads takes bytes, unless serializer opts in to memoryview payload
+        if not getattr(serializer, "accepts_buffer", False):
+            return CachedData(data=serializer.loads(bytes(payload)), expire=expire)
+        return CachedData(data=serializer.loads(payload), expire=expire)
 
     def deserialize(self, raw: Any, serializer: Optional[Serializer]) -> Any:
-        value = {"value": raw, "updated_at": datetime.now(timezone.utc)}
-        return super().deserialize(value, serializer)
+        if serializer is None:
+            raise Exception("serializer is None")
+        if self.legacy_envelope:
+            raw = {"value": raw, "updated_at": datetime.now(timezone.utc)}
+        return serializer.dumps(raw)
+
+    def pack(self, value: bytes, ttl_ms: Optional[int], now_ms: int) -> bytes:
+        if self.legacy_envelope:
+            return value
+        return pack_envelope(value, None if ttl_ms is None else now_ms + ttl_ms)
 
     async def remove_by_key(self, key: str):
+        await self._remove_by_key(key)
+        if self.router is not None:
+            self.router.written((key,))
+
+    async def _remove_by_key(self, key: Any):
+        if self.hash_buckets:
+            bucket, field = key
+            if self.pipeline is not None:
+                await self.pipeline.execute("hdel", bucket, field)
+                return
+            await self.client.hdel(bucket, field)  # type: ignore
+            return
+        if self.pipeline is not None:
+            await self.pipeline.execute("delete", key)
+            return
         await self.client.delete(key)  # type: ignore
 
     async def set_by_key(self, key: str, value: Any, ttl: Optional[timedelta]):
-        if ttl is not None:
-            await self.client.setex(key, int(ttl.total_seconds()), value)  # type: ignore
-        else:
-            await self.client.set(key, value)  # type: ignore
+        await self._set_by_key(key, value, ttl)
+        if self.router is not None:
+            self.router.written((key,))
+
+    async def _set_by_key(self, key: Any, value: Any, ttl: Optional[timedelta]):
+        ttl_ms = _ttl_ms(ttl)
+        value = self.pack(value, ttl_ms, time_ns() // 1_000_000)
+        if self.hash_buckets:
+            await self._hash_set({key: value}, ttl_ms)
+            return
+        if self.pipeline is not None:
+            await self.pipeline.execute("set", key, value, px=ttl_ms)
+            return
+        await self.client.set(key, value, px=ttl_ms)  # type: ignore
 
     async def set_by_keys(self, data: Dict[str, Any], ttl: Optional[timedelta]):
+        await self._set_by_keys(data, ttl)
+        if self.router is not None:
+            self.router.written(data.keys())
+
+    async def _set_by_keys(self, data: Dict[Any, Any], ttl: Optional[timedelta]):
+        ttl_ms = _ttl_ms(ttl)
+        now_ms = time_ns() // 1_000_000
+        if self.hash_buckets:
+            await self._hash_set(
+                {k: self.pack(v, ttl_ms, now_ms) for k, v in data.items()}, ttl_ms
+            )
+            return
+        # in cluster mode, pipeline is split by node and sent concurrently
         async with self.client.pipeline() as pipe:
-            if ttl is not None:
-                seconds = int(ttl.total_seconds())
-                for k, v in data.items():
-                    pipe.setex(k, seconds, v)  # type: ignore
-            else:
-                for k, v in data.items():
-                    pipe.set(k, v)  # type: ignore
+            for k, v in data.items():
+                pipe.set(k, self.pack(v, ttl_ms, now_ms), px=ttl_ms)  # type: ignore
             await pipe.execute()  # type: ignore
+
+    async def _hash_set(
+        self, data: Dict[Tuple[str, str], bytes], ttl_ms: Optional[int]
+    ):
+        buckets: Dict[str, Dict[str, bytes]] = {}
+        for (bucket, field), value in data.items():
+            buckets.setdefault(bucket, {})[field] = value
+        commands: List[Tuple[str, tuple]] = []
+        for bucket, mapping in buckets.items():
+            commands.append(("hset", (bucket, None, None, mapping)))
+            if ttl_ms is None:
+                continue
+            # values carry expire in envelope, so expired fields are never returned
+            if self.hash_field_expire:
+                commands.append(
+                    (
+                        "execute_command",
+                        ("HPEXPIRE", bucket, ttl_ms, "FIELDS", len(mapping), *mapping),
+                    )
+                )
+            else:
+                commands.append(("pexpire", (bucket, ttl_ms)))
+        if self.pipeline is not None:
+            await asyncio.gather(
+                *[self.pipeline.execute(command, *args) for command, args in commands]
+            )
+        else:
+            async with self._pipeline(self.client) as pipe:
+                for command, args in commands:
+                    getattr(pipe, command)(*args)
+                await pipe.execute()
+        if self.hash_field_expire or not self.hash_sweep_writes:
+            return
+        # bucket expire is extended by every write, so fields never read again are
+        # only reclaimed by sweep
+        self._hash_writes += len(buckets)
+        if self._hash_writes >= self.hash_sweep_writes:
+            self._hash_writes = 0
+            await self._hash_sweep(list(buckets))
+
+
+def _ttl_ms(ttl: Optional[timedelta]) -> Optional[int]:
+    if ttl is None:
+        return None
+    return max(int(ttl.total_seconds() * 1000), 1)
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+LEAST_OUTSTANDING = "least_outstanding"
+ROUND_ROBIN = "round_robin"
+
+
+class ReplicaRouter:
+    """
+    Pick endpoint of each read, 0 is primary and 1..n are replicas. Keys written
+    within read_your_writes seconds are read from primary, so reads never miss
+    writes not yet replicated. Failed replica reads are retried on primary.
+
+    :param replicas: number of replicas.
+    :param balance: least_outstanding or round_robin.
+    :param read_your_writes: seconds to read written keys from primary, None to disable.
+    """
+
+    def __init__(
+        self,
+        replicas: int,
+        balance: str = LEAST_OUTSTANDING,
+        read_your_writes: Optional[float] = None,
+    ):
+        if balance not in (LEAST_OUTSTANDING, ROUND_ROBIN):
+            raise Exception(f"unknown replica balance: {balance}")
+        self.replicas = replicas
+        self.balance = balance
+        self.read_your_writes = read_your_writes
+        self.outstanding: List[int] = [0] * (replicas + 1)
+        self.reads: List[int] = [0] * (replicas + 1)
+        self.errors = 0
+        # reads retried on primary after replica failure, not counted in reads
+        self.fallbacks = 0
+        self._next = 0
+        # key -> deadline, window is fixed so insertion order is deadline order
+        self.recent: "OrderedDict[Any, float]" = OrderedDict()
+
+    def written(self, keys: Iterable[Any]):
+        if self.read_your_writes is None:
+            return
+        now = monotonic()
+        deadline = now + self.read_your_writes
+        for key in keys:
+            self.recent[key] = deadline
+            self.recent.move_to_end(key)
+        self._prune(now)
+
+    def _prune(self, now: float):
+        while self.recent:
+            key, deadline = next(iter(self.recent.items()))
+            if deadline > now:
+                return
+            self.recent.popitem(last=False)
+
+    def acquire(self, keys: Iterable[Any]) -> int:
+        index = self._pick(keys)
+        self.outstanding[index] += 1
+        self.reads[index] += 1
+        return index
+
+    def release(self, index: int):
+        self.outstanding[index] -= 1
+
+    def _pick(self, keys: Iterable[Any]) -> int:
+        if self.recent:
+            self._prune(monotonic())
+            if any(key in self.recent for key in keys):
+                return 0
+        # rotate start replica, so ties of least outstanding are spread too
+        self._next = self._next % self.replicas + 1
+        if self.balance == ROUND_ROBIN:
+            return self._next
+        best = self._next
+        for i in range(self.replicas - 1):
+            index = (self._next + i) % self.replicas + 1
+            if self.outstanding[index] < self.outstanding[best]:
+                best = index
+        return best
+
+    async def read(self, keys: Iterable[Any], fn: Callable[[int], Awaitable[T]]) -> T:
+        """
+        Run fn with picked endpoint index, on primary again if replica read fails.
+        """
+        index = self.acquire(keys)
+        try:
+            return await fn(index)
+        except Exception:
+            if index == 0:
+                raise
+            self.errors += 1
+        finally:
+            self.release(index)
+        self.fallbacks += 1
+        return await fn(0)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "primary_reads": self.reads[0],
+            "replica_reads": sum(self.reads[1:]),
+            "replica_outstanding": sum(self.outstanding[1:]),
+            "replica_errors": self.errors,
+            "primary_fallbacks": self.fallbacks,
+        }
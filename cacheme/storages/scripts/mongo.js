@@ -1,4 +1,5 @@
 db = connect('mongodb://localhost/myDatabase');
 
-db.cacheme_data.create_index('key', (unique = True));
-db.cacheme_data.create_index('expire');
+db.cacheme_data.createIndex({ key: 1 }, { unique: true });
+// TTL index, documents are removed by server after expire
+db.cacheme_data.createIndex({ expire: 1 }, { expireAfterSeconds: 0 });
@@ -0,0 +1,195 @@
+import asyncio
+from bisect import bisect, insort
+from datetime import timedelta
+from hashlib import blake2b
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from cacheme.interfaces import Node
+from cacheme.serializer import Serializer
+from cacheme.storages import Storage
+from cacheme.storages.base import BaseStorage
+from cacheme.storages.breaker import OPEN
+from cacheme.storages.offload import OffloadPolicy
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring, each shard is placed on ring as vnodes points. Adding or
+    removing a shard only remaps keys owned by that shard, about 1/N of all keys.
+    """
+
+    def __init__(self, vnodes: int):
+        self.vnodes = vnodes
+        self.points: List[Tuple[int, str]] = []
+        self.hashes: List[int] = []
+
+    def add(self, name: str):
+        for i in range(self.vnodes):
+            insort(self.points, (ring_hash(f"{name}#{i}"), name))
+        self.hashes = [h for h, _ in self.points]
+
+    def remove(self, name: str):
+        self.points = [p for p in self.points if p[1] != name]
+        self.hashes = [h for h, _ in self.points]
+
+    def get(self, key: str) -> str:
+        index = bisect(self.hashes, ring_hash(key))
+        if index == len(self.points):
+            index = 0
+        return self.points[index][1]
+
+
+class ShardedStorage(BaseStorage):
+    """
+    Spread keys over child storages with consistent hashing. Shards are storage urls,
+    created with options, or Storage instances. Shard name is its url unless names
+    are given, names decide ring positions, so keep them stable across deployments.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        shards: Sequence[Union[str, Storage]],
+        names: Optional[Sequence[str]] = None,
+        vnodes: int = 160,
+        **options: Any,
+    ):
+        super().__init__(address=address)
+        if len(shards) == 0:
+            raise Exception("at least one shard is required")
+        if names is not None and len(names) != len(shards):
+            raise Exception("names length mismatch shards")
+        self.options = options
+        self._offload: Optional[OffloadPolicy] = None
+        self.ring = HashRing(vnodes)
+        self.shards: Dict[str, Storage] = {}
+        for i, shard in enumerate(shards):
+            self._add(self._build(shard), names[i] if names is not None else None)
+
+    def _build(self, shard: Union[str, Storage]) -> Storage:
+        if isinstance(shard, str):
+            return Storage(url=shard, **self.options)
+        return shard
+
+    def _add(self, shard: Storage, name: Optional[str]):
+        if shard.is_local():
+            raise Exception("local storage can't be sharded")
+        if name is None:
+            name = shard._storage.address
+        if name in self.shards:
+            raise Exception(f"duplicate shard: {name}")
+        if self._offload is not None and shard.offload is None:
+            shard._storage.offload = self._offload
+        self.shards[name] = shard
+        self.ring.add(name)
+
+    async def add_shard(self, shard: Union[str, Storage], name: Optional[str] = None):
+        """
+        Connect and add a shard, keys owned by the new shard miss once and are
+        loaded again. Stale copies on previous shards are left to expire.
+        """
+        storage = self._build(shard)
+        await storage.connect()
+        self._add(storage, name)
+
+    async def remove_shard(self, name: str):
+        """
+        Remove and close a shard, its keys are remapped to remaining shards.
+        """
+        if len(self.shards) == 1:
+            raise Exception("can't remove last shard")
+        shard = self.shards.pop(name)
+        self.ring.remove(name)
+        await shard.close()
+
+    # (de)serialization happens in shards, apply policy of sharded storage to
+    # shards without their own policy
+    @property  # type: ignore
+    def offload(self) -> Optional[OffloadPolicy]:
+        return self._offload
+
+    @offload.setter
+    def offload(self, policy: Optional[OffloadPolicy]):
+        self._offload = policy
+        for shard in self.shards.values():
+            if shard.offload is None:
+                shard._storage.offload = policy
+
+    def shard(self, node: Node) -> Storage:
+        return self.shards[self.ring.get(node.full_key())]
+
+    async def connect(self):
+        await asyncio.gather(*[shard.connect() for shard in self.shards.values()])
+
+    async def close(self):
+        await asyncio.gather(*[shard.close() for shard in self.shards.values()])
+
+    async def get(self, node: Node, serializer: Optional[Serializer]) -> Any:
+        return await self.shard(node).get(node, serializer)
+
+    async def set(
+        self,
+        node: Node,
+        value: Any,
+        ttl: Optional[timedelta],
+        serializer: Optional[Serializer],
+    ):
+        await self.shard(node).set(node, value, ttl, serializer)
+
+    async def remove(self, node: Node):
+        await self.shard(node).remove(node)
+
+    async def get_all(
+        self,
+        nodes: Sequence[Node],
+        serializer: Optional[Serializer],
+    ) -> Sequence[Tuple[Node, Any]]:
+        if len(nodes) == 0:
+            return []
+        groups: Dict[str, List[Node]] = {}
+        for node in nodes:
+            groups.setdefault(self.ring.get(node.full_key()), []).append(node)
+        gets = await asyncio.gather(
+            *[
+                self.shards[name].get_all(group, serializer)
+                for name, group in groups.items()
+            ]
+        )
+        return [item for result in gets for item in result]
+
+    async def set_all(
+        self,
+        data: Sequence[Tuple[Node, Any]],
+        ttl: Optional[timedelta],
+        serializer: Optional[Serializer],
+    ):
+        groups: Dict[str, List[Tuple[Node, Any]]] = {}
+        for node, value in data:
+            groups.setdefault(self.ring.get(node.full_key()), []).append((node, value))
+        await asyncio.gather(
+            *[
+                self.shards[name].set_all(group, ttl, serializer)
+                for name, group in groups.items()
+            ]
+        )
+
+    def stats(self) -> Dict[str, float]:
+        # sum of shard stats, such as pool available connections of all shards,
+        # breaker state can't be summed and is reported as number of open shards
+        total: Dict[str, float] = {"shards": len(self.shards)}
+        for shard in self.shards.values():
+            for k, v in shard.stats().items():
+                if k == "breaker_state":
+                    continue
+                if k == "reap_last_seconds":
+                    total[k] = max(total.get(k, 0), v)
+                    continue
+                total[k] = total.get(k, 0) + v
+        breakers = [s.breaker for s in self.shards.values() if s.breaker is not None]
+        if breakers:
+            total["breaker_open_shards"] = sum(b.state == OPEN for b in breakers)
+        return total
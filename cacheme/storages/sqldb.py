@@ -1,22 +1,111 @@
+import asyncio
+import logging
 import re
+from time import perf_counter
+from typing import Dict, Optional, cast
 
 from cacheme.storages.base import BaseStorage
 
+logger = logging.getLogger(__name__)
+
 
 class SQLStorage(BaseStorage):
-    def __init__(self, address: str, table: str):
+    def __init__(
+        self,
+        address: str,
+        table: str,
+        reap_interval: Optional[float] = None,
+        reap_batch_size: int = 1000,
+        epoch_expire: bool = False,
+    ):
         match = re.fullmatch(r".\w+", table)
         if match is None:
             raise Exception("invalid table name")
         self.address = address
         self.table = table
+        # store expire as epoch milliseconds integer instead of datetime
+        self.epoch_expire = epoch_expire
+        # seconds between expired rows reaping, None to disable reaper
+        self.reap_interval = reap_interval
+        self.reap_batch_size = reap_batch_size
+        self._reaper: Optional[asyncio.Task] = None
+        self._reaped_rows = 0
+        self._reap_count = 0
+        self._reap_duration = 0.0
         super().__init__(address=address, table=table)
 
     async def _connect(self):
         raise NotImplementedError()
 
+    async def _close(self):
+        return
+
     async def connect(self):
         await self._connect()
+        if self.reap_interval is not None and self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        await self._close()
 
     async def execute_ddl(self, ddl):
         raise NotImplementedError()
+
+    async def ensure_expire_index(self):
+        """
+        Create index on expire column if not exists, used by reaper to find expired rows.
+        """
+        await self.execute_ddl(
+            f"create index if not exists ix_{self.table}_expire on {self.table} (expire)"
+        )
+
+    async def migrate_expire_to_epoch(self):
+        """
+        Convert expire column from datetime to epoch milliseconds integer, use epoch_expire=True after migration.
+        """
+        raise NotImplementedError()
+
+    async def remove_expired(self, limit: int) -> int:
+        """
+        Delete at most limit expired rows, return number of deleted rows.
+        """
+        raise NotImplementedError()
+
+    async def reap(self) -> int:
+        """
+        Delete all expired rows, in batches of reap_batch_size rows.
+        """
+        start = perf_counter()
+        total = 0
+        while True:
+            count = await self.remove_expired(self.reap_batch_size)
+            total += count
+            if count < self.reap_batch_size:
+                break
+            # let other tasks run between batches
+            await asyncio.sleep(0)
+        self._reaped_rows += total
+        self._reap_count += 1
+        self._reap_duration = perf_counter() - start
+        return total
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(cast(float, self.reap_interval))
+            try:
+                await self.reap()
+            except Exception:
+                # storage may be unavailable temporarily, retry on next interval
+                logger.exception("sql storage reap failed")
+
+    def reaper_stats(self) -> Dict[str, float]:
+        if self.reap_interval is None and self._reap_count == 0:
+            return {}
+        return {
+            "reaped_rows": self._reaped_rows,
+            "reap_count": self._reap_count,
+            "reap_last_seconds": self._reap_duration,
+        }
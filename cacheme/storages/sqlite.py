@@ -1,160 +1,335 @@
 import asyncio
+import queue
 import sqlite3
-import sys
-from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, cast
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple, cast
 from urllib.parse import urlparse
 
 from cacheme.interfaces import CachedData
 from cacheme.serializer import Serializer
+from cacheme.storages.base import epoch_ms, expire_at, now_value
 from cacheme.storages.sqldb import SQLStorage
 
 
+# (sql, params list, future, loop), None to stop writer thread.
+# If params is None, sql is a script and runs outside of group commit transaction.
+WriteOp = Optional[
+    Tuple[str, Optional[List[tuple]], asyncio.Future, asyncio.AbstractEventLoop]
+]
+
+
+class SQLiteWriter:
+    """
+    Run writes in a dedicated thread. Pending writes are committed together in one
+    transaction, up to batch_size writes, waiting at most max_latency seconds for
+    more writes after the first one. Futures are resolved when transaction commits.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, batch_size: int, max_latency: float):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue: "queue.SimpleQueue[WriteOp]" = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self._run, name="cacheme-sqlite-writer", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, sql: str, params: Optional[List[tuple]]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((sql, params, future, loop))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        script = None
+        while True:
+            if script is not None:
+                op, script = script, None
+            else:
+                op = self.queue.get()
+            if op is None:
+                return
+            if op[1] is None:
+                self._script(op)
+                continue
+            batch = [op]
+            deadline = monotonic() + self.max_latency
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    op = self.queue.get(timeout=max(deadline - monotonic(), 0))
+                except queue.Empty:
+                    break
+                if op is None:
+                    stop = True
+                    break
+                # scripts run outside of transaction, after current batch
+                if op[1] is None:
+                    script = op
+                    break
+                batch.append(op)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _script(self, op: Any):
+        sql, _, future, loop = op
+        error: Optional[BaseException] = None
+        try:
+            self.conn.executescript(sql)
+        except BaseException as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(_resolve, future, 0, error)
+        except RuntimeError:
+            pass
+
+    def _commit(self, batch: List[Any]):
+        results: List[int] = [0] * len(batch)
+        errors: List[Optional[BaseException]] = [None] * len(batch)
+        try:
+            self.conn.execute("begin")
+            for i, (sql, params, *_) in enumerate(batch):
+                results[i] = self._execute(sql, params)
+            self.conn.execute("commit")
+        except BaseException:
+            if self.conn.in_transaction:
+                self.conn.execute("rollback")
+            # retry one by one, so a bad write only fails its own future
+            for i, (sql, params, *_) in enumerate(batch):
+                try:
+                    results[i] = self._execute(sql, params)
+                except BaseException as e:
+                    errors[i] = e
+        for (*_, future, loop), result, error in zip(batch, results, errors):
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError:
+                # event loop closed
+                pass
+
+    # return number of changed rows
+    def _execute(self, sql: str, params: List[tuple]) -> int:
+        cur = self.conn.executemany(sql, params)
+        count = cur.rowcount
+        cur.close()
+        return count
+
+
+def _resolve(future: asyncio.Future, result: int, error: Optional[BaseException]):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+
+
 class SQLiteStorage(SQLStorage):
-    def __init__(self, address: str, table: str, pool_size: int = 10):
-        super().__init__(address, table=table)
+    def __init__(
+        self,
+        address: str,
+        table: str,
+        pool_size: int = 10,
+        write_batch_size: int = 512,
+        write_latency: float = 0.001,
+        mmap_size: int = 256 * 1024 * 1024,
+        cache_size: int = -16 * 1024,
+        reap_interval: Optional[float] = None,
+        reap_batch_size: int = 1000,
+        incremental_vacuum: bool = False,
+        epoch_expire: bool = False,
+    ):
+        super().__init__(
+            address,
+            table=table,
+            reap_interval=reap_interval,
+            reap_batch_size=reap_batch_size,
+            epoch_expire=epoch_expire,
+        )
         url = urlparse(self.address)
         db = url.path[1:]
         self.db = db
         self.sem = asyncio.BoundedSemaphore(pool_size)
-        self.pool: List[sqlite3.Connection] = []
+        self.pool_size = pool_size
         self.table = table
+        self.write_batch_size = write_batch_size
+        self.write_latency = write_latency
+        # run incremental vacuum after reaping, requires auto_vacuum=incremental
+        self.incremental_vacuum = incremental_vacuum
+        self.writer: Optional[SQLiteWriter] = None
+        self.pragmas = [
+            f"pragma mmap_size={mmap_size}",
+            f"pragma cache_size={cache_size}",
+            "pragma temp_store=memory",
+        ]
+        # reads run in dedicated executor, each thread keeps one connection
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.local = threading.local()
+        self.readers: List[sqlite3.Connection] = []
+        self.max_variables = 999
+        # sqlite3 caches prepared statements by sql text, so keep sql text constant
+        # expired rows are filtered by where clause, never transferred
+        self.get_sql = f"select value, expire from {table} where key=? and (expire is null or expire > ?)"
+        self.get_many_sql: Dict[int, str] = {}
+        self.upsert_sql = f"insert into {table}(key, value, expire) values(?,?,?) on conflict(key) do update set value=EXCLUDED.value, expire=EXCLUDED.expire"
+        self.delete_sql = f"delete from {table} where key=?"
+        self.remove_expired_sql = f"delete from {table} where id in (select id from {table} where expire < ? limit ?)"
 
     async def _connect(self):
         conn = sqlite3.connect(
             self.db, isolation_level=None, timeout=30, check_same_thread=False
         )
-        conn.row_factory = sqlite3.Row
         cur = conn.execute("pragma journal_mode=wal")
         cur.close()
-        self.writer = conn
+        for pragma in self.pragmas:
+            conn.execute(pragma).close()
+        # max number of ? in one statement, getlimit is added in python 3.11
+        if hasattr(conn, "getlimit"):
+            self.max_variables = conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        if self.writer is not None:
+            self.writer.stop()
+        self.writer = SQLiteWriter(conn, self.write_batch_size, self.write_latency)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.pool_size, thread_name_prefix="cacheme-sqlite-reader"
+            )
+
+    async def _close(self):
+        if self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        executor, self.executor = self.executor, None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, writer.stop)
+        writer.conn.close()
+        if executor is not None:
+            await loop.run_in_executor(None, executor.shutdown)
+        for conn in self.readers:
+            conn.close()
+        self.readers = []
+        self.local = threading.local()
+
+    def stats(self) -> Dict[str, float]:
+        waiters = self.sem._waiters  # type: ignore
+        return {
+            "semaphore_available": self.sem._value,  # type: ignore
+            "semaphore_waiters": len(waiters) if waiters else 0,
+            **self.reaper_stats(),
+        }
 
     async def execute_ddl(self, ddl):
-        with sqlite3.connect(self.db, isolation_level=None) as conn:
+        conn = sqlite3.connect(self.db, isolation_level=None, timeout=30)
+        try:
             conn.execute(ddl)
+        finally:
+            conn.close()
 
+    # raw is (value, expire) row
     def serialize(self, raw: Any, serializer: Optional[Serializer]) -> CachedData:
-        data = raw["value"]
+        data, expire = raw
         if serializer is not None:
-            data = serializer.loads(cast(bytes, raw["value"]))
-        updated_at = datetime.fromisoformat(raw["updated_at"])
-        expire = None
-        if raw["expire"] != None:
-            expire = datetime.fromisoformat(raw["expire"]).replace(tzinfo=timezone.utc)
+            data = serializer.loads(cast(bytes, data))
+        if expire is not None and not isinstance(expire, int):
+            expire = epoch_ms(datetime.fromisoformat(expire))
         return CachedData(
             data=data,
             expire=expire,
         )
 
     def get_connection(self) -> sqlite3.Connection:
-        if len(self.pool) > 0:
-            return self.pool.pop(0)
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            return conn
         conn = sqlite3.connect(
             self.db, isolation_level=None, timeout=30, check_same_thread=False
         )
-        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma).close()
+        self.local.conn = conn
+        self.readers.append(conn)
         return conn
 
-    def sync_get_by_key(
-        self,
-        key: str,
-    ) -> Any:
+    def sync_get_by_key(self, key: str, now: Any) -> Any:
         conn = self.get_connection()
-        cur = conn.execute(
-            f"select * from {self.table} where key=?",
-            (key,),
-        )
+        cur = conn.execute(self.get_sql, (key, now))
         data = cur.fetchone()
         cur.close()
-        self.pool.append(conn)
         return data
 
-    def sync_remove_by_key(self, key: str):
-        cur = self.writer.execute(
-            f"delete from {self.table} where key=?",
-            (key,),
-        )
-        cur.close()
-
-    def sync_get_by_keys(
-        self,
-        keys: List[str],
-    ) -> Dict[str, Any]:
+    def sync_get_by_keys(self, keys: List[str], now: Any) -> Dict[str, Any]:
         conn = self.get_connection()
-        sql = (
-            f"SELECT * FROM {self.table} WHERE key in ({', '.join('?' for _ in keys)})"
-        )
-        cur = conn.execute(sql, keys)
-        data = cur.fetchall()
-        cur.close()
-        self.pool.append(conn)
-        return {i["key"]: i for i in data}
-
-    def sync_set_data(
-        self,
-        key: str,
-        value: Any,
-        expire: Optional[datetime],
-    ):
-        cur = self.writer.execute(
-            f"insert into {self.table}(key, value, expire) values(?,?,?) on conflict(key) do update set value=EXCLUDED.value, expire=EXCLUDED.expire",
-            (
-                key,
-                value,
-                expire,
-            ),
-        )
-        cur.close()
-
-    def sync_set_data_batch(
-        self,
-        data: Dict[str, Any],
-        expire: Optional[datetime],
-    ):
-        cur = self.writer.executemany(
-            f"insert into {self.table}(key, value, expire) values(?,?,?) on conflict(key) do update set value=EXCLUDED.value, expire=EXCLUDED.expire",
-            [
-                (
-                    key,
-                    value,
-                    expire,
-                )
-                for key, value in data.items()
-            ],
-        )
-        cur.close()
+        # one variable is used by now
+        limit = self.max_variables - 1
+        results = {}
+        for i in range(0, len(keys), limit):
+            chunk = keys[i : i + limit]
+            sql = self.get_many_sql.get(len(chunk))
+            if sql is None:
+                sql = f"select key, value, expire from {self.table} where key in ({', '.join('?' * len(chunk))}) and (expire is null or expire > ?)"
+                self.get_many_sql[len(chunk)] = sql
+            cur = conn.execute(sql, (*chunk, now))
+            for key, value, expire in cur:
+                results[key] = (value, expire)
+            cur.close()
+        return results
 
     async def get_by_key(self, key: str) -> Any:
-        await self.sem.acquire()
-        if sys.version_info >= (3, 9):
-            data = await asyncio.to_thread(self.sync_get_by_key, key)
-        else:
-            loop = asyncio.get_running_loop()
-            data = await loop.run_in_executor(None, self.sync_get_by_key, key)
-        self.sem.release()
-        return data
+        async with self.sem:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                self.sync_get_by_key,
+                key,
+                now_value(self.epoch_expire),
+            )
 
     async def set_by_key(self, key: str, value: Any, ttl: Optional[timedelta]):
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
-        self.sync_set_data(key, value, expire)
+        expire = expire_at(ttl, self.epoch_expire)
+        await cast(SQLiteWriter, self.writer).submit(
+            self.upsert_sql, [(key, value, expire)]
+        )
 
     async def get_by_keys(self, keys: List[str]) -> Dict[str, Any]:
-        await self.sem.acquire()
-        if sys.version_info >= (3, 9):
-            data = await asyncio.to_thread(self.sync_get_by_keys, keys)
-        else:
-            loop = asyncio.get_running_loop()
-            data = await loop.run_in_executor(None, self.sync_get_by_keys, keys)
-        self.sem.release()
-        return data
+        async with self.sem:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                self.sync_get_by_keys,
+                keys,
+                now_value(self.epoch_expire),
+            )
 
     async def set_by_keys(self, data: Dict[str, Any], ttl: Optional[timedelta]):
-        expire = None
-        if ttl is not None:
-            expire = datetime.now(timezone.utc) + ttl
-        self.sync_set_data_batch(data, expire)
+        expire = expire_at(ttl, self.epoch_expire)
+        await cast(SQLiteWriter, self.writer).submit(
+            self.upsert_sql, [(key, value, expire) for key, value in data.items()]
+        )
 
     async def remove_by_key(self, key: str):
-        self.sync_remove_by_key(key)
+        await cast(SQLiteWriter, self.writer).submit(self.delete_sql, [(key,)])
+
+    async def remove_expired(self, limit: int) -> int:
+        return await cast(SQLiteWriter, self.writer).submit(
+            self.remove_expired_sql, [(now_value(self.epoch_expire), limit)]
+        )
+
+    async def migrate_expire_to_epoch(self):
+        # sqlite column type is flexible, convert datetime text to integer in place
+        await self.execute_ddl(
+            f"update {self.table} set expire = cast(round((julianday(expire) - 2440587.5) * 86400000) as integer) where typeof(expire) = 'text'"
+        )
+
+    async def reap(self) -> int:
+        count = await super().reap()
+        if self.incremental_vacuum and count > 0:
+            await cast(SQLiteWriter, self.writer).submit(
+                "pragma incremental_vacuum", None
+            )
+        return count
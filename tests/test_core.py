@@ -1,6 +1,10 @@
-from asyncio import gather
+import random
+import shutil
+from asyncio import gather, sleep
+from time import monotonic
 from dataclasses import dataclass
 from datetime import timedelta
+from typing import Any, ClassVar, List, Optional, Sequence, Tuple, cast
 from unittest.mock import Mock
 
 import pytest
@@ -17,9 +21,12 @@ from cacheme.core import (
     _awaits_len,
 )
 from cacheme.data import register_storage
+from cacheme.interfaces import Metrics
+from cacheme.interfaces import Node as NodeP
 from cacheme.models import Cache, DynamicNode, Node, sentinel, set_prefix
 from cacheme.serializer import MsgPackSerializer
 from cacheme.storages import Storage
+from cacheme.storages.breaker import CircuitBreaker
 
 
 def node_cls(mock: Mock):
@@ -234,6 +241,431 @@ async def test_stats():
     assert metrics.load_count() == 5
 
 
+@dataclass
+class TierStatsNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        await sleep(0.01)
+        return f"{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [
+            Cache(storage="tier-local1", ttl=None),
+            Cache(storage="tier-local2", ttl=None),
+        ]
+
+
+@pytest.mark.asyncio
+async def test_stats_caches():
+    storage1 = Storage(url="local://lru", size=100)
+    storage2 = Storage(url="local://lru", size=100)
+    await register_storage("tier-local1", storage1)
+    await register_storage("tier-local2", storage2)
+    await get(TierStatsNode("a"))
+    await get(TierStatsNode("a"))
+    await storage1.remove(TierStatsNode("a"))
+    await get(TierStatsNode("a"))
+    metrics = stats(TierStatsNode)
+    local1 = metrics.cache("tier-local1")
+    local2 = metrics.cache("tier-local2")
+    assert set(metrics.caches().keys()) == {"tier-local1", "tier-local2"}
+    assert (local1.hit_count(), local1.miss_count()) == (1, 2)
+    assert (local2.hit_count(), local2.miss_count()) == (1, 1)
+    assert local1.fill_count() == 2
+    assert local2.fill_count() == 1
+    assert local1.fill_failure_count() == 0
+
+    # single-flight joins are counted as hits and as waits
+    await gather(*[get(TierStatsNode("b")) for _ in range(5)])
+    assert metrics.wait_count() == 4
+    assert metrics.hit_count() == 6
+    assert metrics.load_count() == 2
+
+    # waiters miss local tiers too and fill them after the shared load
+    assert (local1.miss_count(), local2.miss_count()) == (7, 6)
+    assert (local1.fill_count(), local2.fill_count()) == (7, 6)
+
+    await get_all([TierStatsNode("a"), TierStatsNode("b"), TierStatsNode("c")])
+    assert (local1.hit_count(), local1.miss_count()) == (3, 8)
+    assert (local2.hit_count(), local2.miss_count()) == (1, 7)
+    assert (local1.fill_count(), local2.fill_count()) == (8, 7)
+
+
+@dataclass
+class DiskTierNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> dict:
+        return {"id": self.id}
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="tier-disk", ttl=None)]
+
+
+@pytest.mark.asyncio
+async def test_disk_tier():
+    directory = f"testdisk{random.randint(0, 50000)}"
+    storage = Storage(url=f"disk:///{directory}")
+    assert storage.is_local()
+    await register_storage("tier-disk", storage)
+    assert await get(DiskTierNode("a")) == {"id": "a"}
+    assert await get(DiskTierNode("a")) == {"id": "a"}
+    results = await get_all([DiskTierNode("a"), DiskTierNode("b")])
+    assert results == [{"id": "a"}, {"id": "b"}]
+    disk = stats(DiskTierNode).cache("tier-disk")
+    assert (disk.hit_count(), disk.miss_count()) == (2, 2)
+    await storage.close()
+    shutil.rmtree(directory)
+
+
+class SlowStorage(Storage):
+    def __init__(self):
+        super().__init__(url="local://lru", size=100)
+        self._is_local = False
+        self.delay = 0.0
+
+    async def get(self, node, serializer):
+        await sleep(self.delay)
+        return await super().get(node, serializer)
+
+
+@dataclass
+class HedgeNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        await sleep(0.01)
+        return f"load-{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="hedge-slow", ttl=None)]
+        hedge_quantile: ClassVar[Optional[float]] = 0.9
+
+
+@pytest.mark.asyncio
+async def test_hedged_get():
+    storage = SlowStorage()
+    await register_storage("hedge-slow", storage)
+    tier = stats(HedgeNode).cache("hedge-slow")
+    await storage.set(HedgeNode("a"), "cached-a", None, None)
+    # no hedging until enough latency samples
+    storage.delay = 0.05
+    assert await get(HedgeNode("a")) == "cached-a"
+    assert tier.hedge_count() == 0
+    assert tier.latency_quantile(0.9) is None
+    for _ in range(tier.latency_min_samples):
+        tier._record_latency(2_000_000)
+    assert tier.latency_quantile(0.9) == 2_000_000
+
+    # slow tier is hedged by source load, which wins
+    await storage.set(HedgeNode("b"), "cached-b", None, None)
+    storage.delay = 0.5
+    start = monotonic()
+    assert await get(HedgeNode("b")) == "load-b"
+    assert monotonic() - start < 0.2
+    assert (tier.hedge_count(), tier.hedge_win_count()) == (1, 1)
+
+    # fast tier answers before threshold, no hedge
+    storage.delay = 0
+    await storage.set(HedgeNode("c"), "cached-c", None, None)
+    assert await get(HedgeNode("c")) == "cached-c"
+    assert (tier.hedge_count(), tier.hedge_win_count()) == (1, 1)
+
+    # tier miss starts source load at once
+    assert await get(HedgeNode("d")) == "load-d"
+    assert tier.miss_count() == 1
+
+
+class FailingStorage(Storage):
+    def __init__(self, breaker: CircuitBreaker):
+        super().__init__(url="local://lru", size=100)
+        self._is_local = False
+        self.breaker = breaker
+        self.fail = False
+        self.delay = 0.0
+        self.calls: List[str] = []
+        for name in ["get", "get_all", "set", "set_all"]:
+            setattr(self._storage, name, self._failing(getattr(self._storage, name)))
+
+    def _failing(self, fn):
+        async def wrapper(*args):
+            self.calls.append(fn.__name__)
+            await sleep(self.delay)
+            if self.fail:
+                raise Exception("storage down")
+            return await fn(*args)
+
+        return wrapper
+
+
+@dataclass
+class BreakerNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        return f"load-{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="breaker-remote", ttl=None)]
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    breaker = CircuitBreaker(min_calls=4, open_seconds=0.1)
+    storage = FailingStorage(breaker)
+    await register_storage("breaker-remote", storage)
+    tier = stats(BreakerNode).cache("breaker-remote")
+    storage.fail = True
+    # failed reads don't fail requests, breaker opens after 4 failed calls
+    for id in ["a", "b", "c"]:
+        assert await get(BreakerNode(id)) == f"load-{id}"
+    assert await get_all([BreakerNode("d")]) == ["load-d"]
+    assert breaker.state == "open"
+    assert tier.bypass_count() == 4
+    assert storage.stats()["breaker_state"] == 1
+    # open breaker skips tier
+    assert await get_all([BreakerNode("e"), BreakerNode("f")]) == ["load-e", "load-f"]
+    assert await get(BreakerNode("g")) == "load-g"
+    assert tier.bypass_count() == 6
+    assert tier.fill_failure_count() == 0
+    # half open probe succeeds and closes breaker
+    storage.fail = False
+    await sleep(0.1)
+    assert breaker.state == "half_open"
+    assert await get(BreakerNode("h")) == "load-h"
+    assert breaker.state == "closed"
+    assert await get(BreakerNode("h")) == "load-h"
+    assert tier.hit_count() == 1
+    assert storage.stats()["breaker_open_count"] == 1
+
+
+@dataclass
+class ProbeNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        return f"load-{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [
+            Cache(storage="breaker-front", ttl=None),
+            Cache(storage="breaker-probe", ttl=None),
+        ]
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_single_probe():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0.05)
+    storage = FailingStorage(breaker)
+    front = SlowStorage()
+    await register_storage("breaker-front", front)
+    await register_storage("breaker-probe", storage)
+    tier = stats(ProbeNode).cache("breaker-probe")
+    storage.fail = True
+    assert await get(ProbeNode("probe-a")) == "load-probe-a"
+    assert breaker.state == "open"
+    await sleep(0.05)
+    storage.fail = False
+    storage.delay = 0.02
+    storage.calls.clear()
+    bypass = tier.bypass_count()
+    # all requests pass allow() of breaker tier while reading slow front tier, only
+    # one of them calls storage
+    front.delay = 0.02
+    ids = [f"probe-{i}" for i in range(5)]
+    results = await gather(
+        *[get(ProbeNode(id)) for id in ids[:3]],
+        get_all([ProbeNode(id) for id in ids[3:]]),
+    )
+    assert results == [f"load-{id}" for id in ids[:3]] + [
+        [f"load-{id}" for id in ids[3:]]
+    ]
+    assert storage.calls.count("get") + storage.calls.count("get_all") == 1
+    assert tier.bypass_count() == bypass + 3
+    assert breaker.state == "closed"
+    assert not breaker._probing
+
+
+@dataclass
+class BypassNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        await sleep(0.001)
+        return f"load-{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="bypass-slow", ttl=None)]
+        bypass_slow_tiers = True
+
+
+@pytest.mark.asyncio
+async def test_bypass_slow_tier():
+    storage = SlowStorage()
+    await register_storage("bypass-slow", storage)
+    metrics = stats(BypassNode)
+    tier = metrics.cache("bypass-slow")
+    # no bypass until enough source loads
+    for i in range(tier.latency_min_samples):
+        assert await get(BypassNode(f"warm-{i}")) == f"load-warm-{i}"
+    assert metrics.source_load_count() == tier.latency_min_samples
+    assert tier.bypass_count() == 0
+    # tier median latency is above average source load time
+    for _ in range(2 * tier.latency_min_samples):
+        tier._record_latency(100_000_000)
+    await storage.set(BypassNode("a"), "cached-a", None, None)
+    storage.delay = 0.5
+    start = monotonic()
+    for _ in range(15):
+        assert await get(BypassNode("a")) == "load-a"
+    assert monotonic() - start < 0.4
+    assert tier.bypass_count() == 15
+    # every 16th request still reads tier
+    storage.delay = 0
+    assert await get(BypassNode("a")) == "cached-a"
+    assert tier.bypass_count() == 15
+
+
+@dataclass
+class WindowStatsNode(Node):
+    id: str
+    delay: float = 0
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        await sleep(self.delay)
+        return f"{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="local", ttl=None)]
+
+
+@pytest.mark.asyncio
+async def test_stats_window(monkeypatch):
+    await register_storage("local", Storage(url="local://lru", size=100))
+    now = 1000.0
+    monkeypatch.setattr("cacheme.interfaces.monotonic", lambda: now)
+    metrics = stats(WindowStatsNode)
+    assert metrics.window(60).request_count() == 0
+    await get(WindowStatsNode("a"))
+    await get(WindowStatsNode("a"))
+    now += 100
+    await get(WindowStatsNode("a"))
+    await get(WindowStatsNode("b"))
+    now += 1
+    await get(WindowStatsNode("a"))
+    window = metrics.window(60)
+    assert window.seconds == 60
+    assert window.request_count() == 3
+    assert window.hit_count == 2
+    assert window.load_count() == 1
+    assert window.hit_rate() == 2 / 3
+    assert metrics.window(1).request_count() == 1
+    assert metrics.window(3600).seconds == Metrics.window_size
+    assert metrics.window(3600).request_count() == 5
+    now += 500
+    assert metrics.window(60).request_count() == 0
+    assert metrics.request_count() == 5
+
+
+@pytest.mark.asyncio
+async def test_stats_slowest_loads():
+    await register_storage("local", Storage(url="local://lru", size=100))
+    metrics = stats(WindowStatsNode)
+    metrics._slow_keys.clear()
+    await get(WindowStatsNode("slow-a", 0.05))
+    await get(WindowStatsNode("slow-b", 0.01))
+    await get_all([WindowStatsNode("slow-c", 0.03), WindowStatsNode("slow-d")])
+    for i in range(20):
+        await get(WindowStatsNode(f"fast-{i}"))
+    slowest = metrics.slowest_loads()
+    assert len(slowest) == Metrics.slow_keys_size
+    key_a = WindowStatsNode("slow-a").full_key()
+    # slow-c and slow-d are loaded in same batch
+    assert [k for k, _ in slowest[:4]] == [
+        key_a,
+        *sorted(
+            [
+                WindowStatsNode("slow-c").full_key(),
+                WindowStatsNode("slow-d").full_key(),
+            ],
+            reverse=True,
+        ),
+        WindowStatsNode("slow-b").full_key(),
+    ]
+    assert slowest[0][1] >= 50_000_000
+    # same key is tracked once
+    await invalidate(WindowStatsNode("slow-a"))
+    await get(WindowStatsNode("slow-a", 0.06))
+    slowest = metrics.slowest_loads()
+    assert slowest[0][0] == key_a
+    assert slowest[0][1] >= 60_000_000
+    assert len([k for k, _ in slowest if k == key_a]) == 1
+
+
+@dataclass
+class BatchLoadNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        return f"{self.id}"
+
+    @classmethod
+    async def load_all(cls, nodes: Sequence[NodeP]) -> Sequence[Tuple[NodeP, Any]]:
+        await sleep(0.05)
+        return [(node, f"{cast(BatchLoadNode, node).id}") for node in nodes]
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="local", ttl=None)]
+
+
+@pytest.mark.asyncio
+async def test_stats_batch_source_load():
+    await register_storage("local", Storage(url="local://lru", size=100))
+    metrics = stats(BatchLoadNode)
+    nodes = [BatchLoadNode(f"batch-{i}") for i in range(20)]
+    assert await get_all(nodes) == [node.id for node in nodes]
+    # batch duration is counted once, not once per key
+    assert metrics.source_load_count() == 20
+    assert 50_000_000 <= metrics._total_source_load_time < 100_000_000
+    assert metrics._total_source_load_time <= metrics._total_load_time
+    assert metrics.average_source_load_time() < 5_000_000
+    # each key of batch is tracked as slow as whole batch
+    assert all(d >= 50_000_000 for _, d in metrics.slowest_loads())
+
+
 @pytest.mark.asyncio
 async def test_invalidate():
     await register_storage("local", Storage(url="local://tlfu", size=50))
@@ -0,0 +1,168 @@
+import os
+import random
+from asyncio import gather, sleep
+from dataclasses import dataclass
+from typing import ClassVar, List, Optional
+
+import pytest
+
+from cacheme import instrumentation
+from cacheme.core import get, get_all
+from cacheme.data import register_storage
+from cacheme.instrumentation import Event, OpenTelemetryHook, add_hook, remove_hook
+from cacheme.models import Cache, Node
+from cacheme.serializer import MsgPackSerializer, Serializer
+from cacheme.storages import Storage
+from tests.utils import setup_storage
+
+
+@dataclass
+class HookNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        await sleep(0.01)
+        return f"{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [
+            Cache(storage="hook-local", ttl=None),
+            Cache(storage="hook-sqlite", ttl=None),
+        ]
+        serializer: ClassVar[Optional[Serializer]] = MsgPackSerializer()
+
+
+@pytest.mark.asyncio
+async def test_hooks():
+    filename = f"test{random.randint(0, 50000)}"
+    sqlite = Storage(url=f"sqlite:///{filename}", table="data")
+    await register_storage("hook-local", Storage(url="local://lru", size=100))
+    await register_storage("hook-sqlite", sqlite)
+    await setup_storage(sqlite._storage)
+    events: List[Event] = []
+    add_hook(events.append)
+    try:
+        await gather(get(HookNode("a")), get(HookNode("a")))
+        stages = [(e.stage, e.tier) for e in events]
+        assert stages[:6] == [
+            (instrumentation.LOCAL, "hook-local"),
+            (instrumentation.LOCAL, "hook-local"),
+            (instrumentation.REMOTE, "hook-sqlite"),
+            (instrumentation.LOAD, None),
+            (instrumentation.FILL, "hook-local"),
+            (instrumentation.DUMPS, "sqlite"),
+        ]
+        # sqlite write is committed in writer thread, waiter may resume first
+        assert sorted(stages[6:], key=str) == sorted(
+            [
+                (instrumentation.FILL, "hook-sqlite"),
+                (instrumentation.WAIT, None),
+                (instrumentation.FILL, "hook-local"),
+            ],
+            key=str,
+        )
+        for e in events:
+            assert e.node is HookNode
+            assert e.keys == 1
+            assert e.duration >= 0
+        load = [e for e in events if e.stage == instrumentation.LOAD][0]
+        assert load.duration >= 10_000_000
+
+        events.clear()
+        await get_all([HookNode("b"), HookNode("c")])
+        assert [(e.stage, e.keys) for e in events] == [
+            (instrumentation.LOCAL, 2),
+            (instrumentation.REMOTE, 2),
+            (instrumentation.LOAD, 2),
+            (instrumentation.FILL, 2),
+            (instrumentation.DUMPS, 2),
+            (instrumentation.FILL, 2),
+        ]
+    finally:
+        remove_hook(events.append)
+    assert instrumentation._hooks == []
+    os.remove(filename)
+    os.remove(f"{filename}-shm")
+    os.remove(f"{filename}-wal")
+
+
+@dataclass
+class LateHookNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        await sleep(0.05)
+        return f"{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="late-hook-local", ttl=None)]
+
+
+@pytest.mark.asyncio
+async def test_hook_added_during_await():
+    await register_storage("late-hook-local", Storage(url="local://lru", size=100))
+    events: List[Event] = []
+
+    async def add_later():
+        await sleep(0.01)
+        add_hook(events.append)
+
+    try:
+        # second request is waiting on single-flight load when hook is added
+        result = await gather(
+            get(LateHookNode("a")),
+            get(LateHookNode("a")),
+            get_all([LateHookNode("b")]),
+            add_later(),
+        )
+        assert result[:3] == ["a", "a", ["b"]]
+        # stages started before hook was added are not emitted
+        assert instrumentation.WAIT not in [e.stage for e in events]
+    finally:
+        remove_hook(events.append)
+
+
+class FakeSpan:
+    def __init__(self, name, start_time, attributes):
+        self.name = name
+        self.start_time = start_time
+        self.attributes = attributes
+        self.end_time = None
+
+    def end(self, end_time):
+        self.end_time = end_time
+
+
+class FakeTracer:
+    def __init__(self):
+        self.spans: List[FakeSpan] = []
+
+    def start_span(self, name, start_time, attributes):
+        span = FakeSpan(name, start_time, attributes)
+        self.spans.append(span)
+        return span
+
+
+def test_opentelemetry_hook():
+    tracer = FakeTracer()
+    hook = OpenTelemetryHook(tracer)
+    hook(Event(instrumentation.REMOTE, HookNode, 3, "redis", 100, 20))
+    hook(Event(instrumentation.LOAD, HookNode, 1, None, 200, 50))
+    remote, load = tracer.spans
+    assert remote.name == "cacheme.remote"
+    assert (remote.start_time, remote.end_time) == (100, 120)
+    assert remote.attributes == {
+        "cacheme.node": "HookNode",
+        "cacheme.keys": 3,
+        "cacheme.tier": "redis",
+    }
+    assert load.name == "cacheme.load"
+    assert "cacheme.tier" not in load.attributes
@@ -0,0 +1,65 @@
+import asyncio
+from asyncio.base_events import Server
+from dataclasses import dataclass
+from typing import cast
+
+import pytest
+
+from cacheme.core import get
+from cacheme.data import register_storage
+from cacheme.models import Cache, Node
+from cacheme.prometheus import render, start_http_server
+from cacheme.storages import Storage
+
+
+@dataclass
+class PromNode(Node):
+    id: str
+
+    def key(self) -> str:
+        return f"{self.id}"
+
+    async def load(self) -> str:
+        return f"{self.id}"
+
+    class Meta(Node.Meta):
+        version = "v1"
+        caches = [Cache(storage="prom-local", ttl=None)]
+
+
+@pytest.mark.asyncio
+async def test_render():
+    await register_storage("prom-local", Storage(url="local://lru", size=100))
+    await get(PromNode("a"))
+    await get(PromNode("a"))
+    text = render()
+    label = 'node="tests.test_prometheus.PromNode"'
+    assert f"cacheme_hits_total{{{label}}} 1" in text
+    assert f"cacheme_misses_total{{{label}}} 1" in text
+    assert f"cacheme_load_success_total{{{label}}} 1" in text
+    assert f"cacheme_source_loads_total{{{label}}} 1" in text
+    assert f'cacheme_cache_hits_total{{{label},storage="prom-local"}} 1' in text
+    assert f'cacheme_cache_fills_total{{{label},storage="prom-local"}} 1' in text
+    assert f'cacheme_cache_hedges_total{{{label},storage="prom-local"}} 0' in text
+    assert f'cacheme_cache_bypasses_total{{{label},storage="prom-local"}} 0' in text
+    assert "cacheme_inflight_loads 0" in text
+    # each family is declared once
+    assert text.count("# TYPE cacheme_hits_total counter") == 1
+
+
+@pytest.mark.asyncio
+async def test_http_server():
+    await register_storage("prom-local", Storage(url="local://lru", size=100))
+    await get(PromNode("b"))
+    server = cast(Server, await start_http_server(0, host="127.0.0.1"))
+    port = server.sockets[0].getsockname()[1]
+    for path, status in [("/metrics", b"200"), ("/foo", b"404")]:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        assert response.split(b" ")[1] == status
+        if status == b"200":
+            assert b"cacheme_hits_total" in response
+    server.close()
+    await server.wait_closed()
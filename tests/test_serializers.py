@@ -1,3 +1,7 @@
+import os
+import pickle
+import struct
+import zlib
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 
@@ -72,17 +76,31 @@ class FooBar(BaseModel):
     [
         {
             "n": PICKLE,
-            "s": [PickleSerializer(), CompressedPickleSerializer()],
+            "s": [
+                PickleSerializer(),
+                CompressedPickleSerializer(),
+                BinaryPickleSerializer(),
+                AdaptiveCompressedSerializer(BinaryPickleSerializer(), min_size=10),
+            ],
             "tags": [],
         },
         {
             "n": MSGPACK,
-            "s": [MsgPackSerializer(), CompressedMsgPackSerializer()],
+            "s": [
+                MsgPackSerializer(),
+                CompressedMsgPackSerializer(),
+                AdaptiveCompressedSerializer(MsgPackSerializer(), min_size=10),
+                DictionaryCompressedSerializer(MsgPackSerializer(), train_samples=3),
+            ],
             "tags": [TUPLE_TO_LIST],
         },
         {
             "n": JSON,
-            "s": [JSONSerializer(), CompressedJSONSerializer()],
+            "s": [
+                JSONSerializer(),
+                CompressedJSONSerializer(),
+                AdaptiveCompressedSerializer(JSONSerializer(), min_size=10),
+            ],
             "tags": [TUPLE_TO_LIST],
         },
     ],
@@ -97,3 +115,145 @@ def test_serializers(data, serializer_data):
         if TUPLE_TO_LIST in serializer_data["tags"] and isinstance(value, tuple):
             value = list(value)
         assert serialized == value
+
+
+class Buffer:
+    def __init__(self, data: bytearray):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return Buffer, (pickle.PickleBuffer(self.data),)
+
+
+def test_binary_pickle_out_of_band():
+    serializer = BinaryPickleSerializer(buffer_threshold=1024)
+    large = b"a" * 4096
+    # top level bytes and bytearray are stored as is, after a marker byte
+    for value in [large, bytearray(large)]:
+        blob = serializer.dumps(value)
+        assert len(blob) == len(value) + 1
+        loaded = serializer.loads(memoryview(blob))
+        assert type(loaded) is type(value) and loaded == value
+    # PickleBuffer objects are framed out-of-band, loaded as views of input
+    buffers = {"small": Buffer(bytearray(b"b" * 10)), "large": Buffer(bytearray(large))}
+    blob = serializer.dumps(buffers)
+    assert blob[0] == 0
+    loaded = serializer.loads(blob)
+    assert bytes(loaded["small"].data) == b"b" * 10
+    assert isinstance(loaded["large"].data, memoryview)
+    assert loaded["large"].data.obj is blob
+    assert bytes(loaded["large"].data) == large
+    # small values are plain pickle, readable by pickle.loads
+    assert pickle.loads(serializer.dumps([1, "a"])) == [1, "a"]
+    assert (
+        BinaryPickleSerializer(None).loads(BinaryPickleSerializer(None).dumps(large))
+        == large
+    )
+
+
+class ReversedCodec:
+    id = 100
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data)[::-1]
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data[::-1])
+
+
+def test_adaptive_compression():
+    serializer = AdaptiveCompressedSerializer(MsgPackSerializer(), min_size=64)
+    # small values are not compressed
+    blob = serializer.dumps("foo")
+    assert blob[0] == 0
+    assert serializer.loads(blob) == "foo"
+    # compressible values
+    compressible = {"foo": "bar" * 100}
+    blob = serializer.dumps(compressible)
+    assert blob[0] == ZlibCodec.id
+    assert len(blob) < 64
+    assert serializer.loads(blob) == compressible
+    # poor ratio
+    random_bytes = os.urandom(1024)
+    blob = serializer.dumps(random_bytes)
+    assert blob[0] == 0
+    assert serializer.loads(blob) == random_bytes
+    # legacy CompressedSerializer payloads
+    legacy = CompressedMsgPackSerializer().dumps({"a": 1})
+    assert serializer.loads(legacy) == {"a": 1}
+    # payloads of previous codec are readable after codec change
+    register_codec(ReversedCodec)
+    with pytest.raises(Exception):
+        register_codec(type("DupCodec", (ReversedCodec,), {}))
+    new = AdaptiveCompressedSerializer(
+        MsgPackSerializer(), codec=ReversedCodec(), min_size=64
+    )
+    text = "ab" * 100
+    blob = new.dumps(text)
+    assert blob[0] == ReversedCodec.id
+    assert serializer.loads(blob) == text
+    assert new.loads(serializer.dumps(text)) == text
+
+
+def test_dictionary_compression():
+    trained = []
+    serializer = DictionaryCompressedSerializer(
+        JSONSerializer(),
+        train_samples=20,
+        on_train=lambda id, data: trained.append((id, data)),
+    )
+    values = [
+        {"id": i, "name": f"user-{i}", "email": f"user-{i}@example.com", "active": True}
+        for i in range(100)
+    ]
+    blobs = [serializer.dumps(v) for v in values]
+    assert len(trained) == 1
+    id, data = trained[0]
+    assert id == dictionary_id(data)
+    # values before training are compressed without dictionary
+    assert blobs[0][0] == 1
+    assert blobs[-1][0] == 2
+    assert len(blobs[-1]) < len(CompressedJSONSerializer().dumps(values[-1])) / 2
+    assert [serializer.loads(b) for b in blobs] == values
+    # another process with persisted dictionary
+    other = DictionaryCompressedSerializer(JSONSerializer(), dictionaries=[data])
+    assert [other.loads(b) for b in blobs] == values
+    assert other.dumps(values[0]) == serializer.dumps(values[0])
+    assert serializer.loads(CompressedJSONSerializer().dumps(values[0])) == values[0]
+    # roll to new dictionary, old payloads stay readable
+    serializer.retrain()
+    new_values = [{"uid": i, "tags": ["a", "b"], "score": i * 1.5} for i in range(20)]
+    new_blobs = [serializer.dumps(v) for v in new_values]
+    assert len(trained) == 2
+    with pytest.raises(Exception):
+        serializer.remove_dictionary(trained[1][0])
+    assert serializer.loads(blobs[-1]) == values[-1]
+    serializer.remove_dictionary(id)
+    with pytest.raises(UnknownDictionaryError):
+        serializer.loads(blobs[-1])
+    assert serializer.loads(serializer.dumps(new_values[0])) == new_values[0]
+    assert new_blobs[-1][1:5] == struct.pack("<I", trained[1][0])
+
+
+def test_dictionary_trained_separately():
+    values = [{"id": i, "name": f"user-{i}", "tags": ["tag"] * 20} for i in range(50)]
+    # default is no training, compressed without dictionary and readable anywhere
+    default = DictionaryCompressedSerializer(JSONSerializer())
+    assert default.train_samples == 0
+    blob = default.dumps(values[-1])
+    assert blob[0] == 1
+    assert DictionaryCompressedSerializer(JSONSerializer()).loads(blob) == values[-1]
+    # two processes trained their own dictionaries
+    a = DictionaryCompressedSerializer(JSONSerializer(), train_samples=10)
+    b = DictionaryCompressedSerializer(JSONSerializer(), train_samples=10)
+    blobs_a = [a.dumps(v) for v in values]
+    blobs_b = [b.dumps(v) for v in list(reversed(values))]
+    assert blobs_a[-1][1:5] != blobs_b[-1][1:5]
+    # values compressed with unknown dictionary raise, storages treat them as misses
+    with pytest.raises(UnknownDictionaryError):
+        b.loads(blobs_a[-1])
+    with pytest.raises(UnknownDictionaryError):
+        a.loads(blobs_b[-1])
+    # values compressed before training are readable by both
+    assert b.loads(blobs_a[0]) == values[0]
+    assert a.loads(blobs_b[0]) == values[-1]
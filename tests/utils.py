@@ -1,8 +1,6 @@
 from typing import Any
 from urllib.parse import urlparse
 
-import motor.motor_asyncio as mongo
-
 from cacheme.storages.mongo import MongoStorage
 from cacheme.storages.sqldb import SQLStorage
 
@@ -20,7 +18,4 @@ async def setup_storage(storage: Any):
             await storage.execute_ddl(ddl)
 
     if isinstance(storage, MongoStorage):
-        client = mongo.AsyncIOMotorClient(storage.address)
-        table = client[storage.database][storage.collection]
-        await table.create_index("key", unique=True)
-        await table.create_index("expire")
+        await storage.ensure_indexes()